@@ -0,0 +1,232 @@
+"""discovery.py -
+
+Parallel discovery of ComPort firmware on the serial ports of this host.
+
+All candidate tty devices are probed concurrently by a thread pool, each probe
+writes the identification command and waits at most `timeout` seconds for a
+valid <N>...</N> frame. Opening the port of an Arduino toggles DTR which resets
+the ATmega328p, the bootloader then ignores the first 1-2 seconds of input.
+Ports are opened with DTR deasserted where the platform allows it, and the
+command is repeated every `retry` seconds until the board answers.
+Identified devices are cached keyed by the USB serial number and interface
+number read from sysfs, so on the next start a device whose key is already known
+is not probed again, even if it came up under a different /dev/ttyUSB* name.
+The interface number tells apart the ttys of one multi-port adapter (FT2232,
+FT4232, composite CDC-ACM), which all share the serial number of the USB device.
+This replaces hand written udev rules (docs/etc_udev_rules_d.txt).
+
+Usage:
+  discovery.py [--timeout=TIMEOUT] [--workers=WORKERS] [--cache=CACHE] [--refresh]
+  discovery.py (-h | --help)
+
+Options:
+  -h, --help
+  --timeout=TIMEOUT  [default: 3.0]
+  --workers=WORKERS  [default: 8]
+  --cache=CACHE      [default: ~/.cache/pyhardware/discovery.json]
+  --refresh          Ignore the cache and probe every port
+
+"""
+
+# Python
+import os
+import json
+import glob
+import time
+from multiprocessing.pool import ThreadPool
+
+from framer import Framer
+
+##########################################################################################
+# Global definitions
+PATTERNS    = ('/dev/ttyUSB*', '/dev/ttyACM*')
+CACHE_FILE  = '~/.cache/pyhardware/discovery.json'
+PROBE_CMD   = 'I'
+TIMEOUT     = 3.0
+RETRY       = 0.25
+WORKERS     = 8
+SYS_TTY     = '/sys/class/tty'
+SYS_DEVICES = '/sys/devices'
+BY_ID_DIR   = '/dev/serial/by-id'
+
+def candidate_ports(patterns=PATTERNS):
+    ports = []
+    for pattern in patterns:
+        ports.extend(glob.glob(pattern))
+    return sorted(ports)
+
+def usb_attribute(port, attribute):
+    """Returns the first sysfs attribute found walking up from the tty of port, None when absent"""
+    name = os.path.basename(os.path.realpath(port))
+    path = os.path.realpath(os.path.join(SYS_TTY, name, 'device'))
+    while path.startswith(SYS_DEVICES) and path != SYS_DEVICES:
+        attribute_file = os.path.join(path, attribute)
+        if os.path.isfile(attribute_file):
+            try:
+                with open(attribute_file) as f:
+                    return f.read().strip() or None
+            except (IOError, OSError):
+                return None
+        path = os.path.dirname(path)
+    return None
+
+def usb_serial_number(port):
+    """Returns the USB serial number of the device behind port, None when it has none"""
+    return usb_attribute(port, 'serial')
+
+def usb_interface_number(port):
+    """Returns the USB interface number of port, e.g. '01' for the second port of an FT2232"""
+    return usb_attribute(port, 'bInterfaceNumber')
+
+def device_key(port):
+    """
+    Returns 'serial-ifNN', a name of the device behind port that survives re-plugging and
+    differs between the ttys of one adapter, None when the device has no serial number.
+    """
+    serial_number = usb_serial_number(port)
+    if serial_number is None:
+        return None
+    interface = usb_interface_number(port)
+    return serial_number if interface is None else '{0}-if{1}'.format(serial_number, interface)
+
+def stable_port(port):
+    """
+    Returns the /dev/serial/by-id link of port when udev created one, port otherwise. The link
+    follows the device when it is re-plugged and comes back under another ttyUSB name.
+    """
+    target = os.path.realpath(port)
+    if os.path.isdir(BY_ID_DIR):
+        for name in sorted(os.listdir(BY_ID_DIR)):
+            link = os.path.join(BY_ID_DIR, name)
+            if os.path.realpath(link) == target:
+                return link
+    return port
+
+def open_serial(port, baudrate, timeout):
+    """Opens port without asserting DTR, which would reset an Arduino, where supported"""
+    import serial
+    com = serial.Serial()
+    com.port     = port
+    com.baudrate = baudrate
+    com.timeout  = timeout
+    try:
+        com.dtr = False
+    except AttributeError:
+        pass
+    com.open()
+    return com
+
+def probe(port, timeout=TIMEOUT, baudrate=115200, cmd=PROBE_CMD, opener=open_serial, retry=RETRY):
+    """
+    Sends cmd to port every retry seconds and waits up to timeout seconds for a ComPort frame,
+    so a board that was reset by opening the port is identified once its bootloader is done.
+    Returns a dict describing the device or None when nothing identifiable answered.
+    """
+    try:
+        com = opener(port, baudrate, timeout)
+    except Exception:
+        return None
+
+    framer = Framer()
+    try:
+        stop_at    = time.time() + timeout
+        next_write = 0
+        while time.time() < stop_at:
+            if time.time() >= next_write:
+                com.write(cmd + '\n')
+                next_write = time.time() + retry
+            waiting = com.inWaiting()
+            if not waiting:
+                time.sleep(0.01)
+                continue
+            for cmd_number, payload, raw in framer.feed(com.read(waiting)):
+                try:
+                    data = json.loads(payload)
+                except ValueError:
+                    continue
+                return {'port'       : port,
+                        'firmware'   : 'ComPort',
+                        'cmd_number' : int(cmd_number),
+                        'response'   : data.get('data') if isinstance(data, dict) else data}
+    except Exception:
+        return None
+    finally:
+        com.close()
+    return None
+
+def load_cache(cache_file):
+    try:
+        with open(os.path.expanduser(cache_file)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+def save_cache(cache_file, cache):
+    path = os.path.expanduser(cache_file)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, path)
+
+def discover(ports=None, timeout=TIMEOUT, workers=WORKERS, cache_file=CACHE_FILE, refresh=False, **kwargs):
+    """
+    Returns a list of {'port', 'serial_number', 'key', 'firmware', ...} dicts, one per ComPort
+    device. Ports whose device_key() is in the cache are not probed unless refresh is set.
+    Extra kwargs are passed to probe().
+    """
+    if ports is None:
+        ports = candidate_ports()
+    cache = dict() if cache_file is None else load_cache(cache_file)
+
+    found     = []
+    to_probe  = []
+    for port in ports:
+        key = device_key(port)
+        if key and key in cache and not refresh:
+            device = dict(cache[key])
+            device.update({'port' : port, 'key' : key, 'cached' : True})
+            found.append(device)
+        else:
+            to_probe.append((port, key))
+
+    if to_probe:
+        pool = ThreadPool(max(1, min(workers, len(to_probe))))
+        try:
+            results = pool.map(lambda item: probe(item[0], timeout, **kwargs), to_probe)
+        finally:
+            pool.close()
+            pool.join()
+        for (port, key), device in zip(to_probe, results):
+            if device is None:
+                continue
+            device.update({'serial_number' : usb_serial_number(port), 'key' : key, 'cached' : False})
+            found.append(device)
+            if key:
+                cache[key] = dict((k, v) for k, v in device.items() if k not in ('port', 'key', 'cached'))
+
+    if cache_file is not None and to_probe:
+        save_cache(cache_file, cache)
+    return sorted(found, key=lambda device: device['port'])
+
+def open_devices(devices=None, **kwargs):
+    """Returns a SerialRedisCom for every discovered device, kwargs go to SerialRedisCom"""
+    from serialcom import SerialRedisCom
+
+    if devices is None:
+        devices = discover()
+    return [SerialRedisCom(port=device['port'], **kwargs) for device in devices]
+
+############################################################################################
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    devices = discover(timeout=float(arguments['--timeout']),
+                       workers=int(arguments['--workers']),
+                       cache_file=arguments['--cache'],
+                       refresh=arguments['--refresh'])
+    for device in devices:
+        print('{0:16s} {1:20s} {2}'.format(device['port'], device['serial_number'] or '-', device['response']))
@@ -0,0 +1,220 @@
+"""emulator.py -
+
+Emulator of the ComPort firmware serial interface, used for testing and benchmarking
+SerialRedisCom and the framer without hardware.
+
+EmulatedComPort implements the part of the serial.Serial API used in this package
+(write, read, inWaiting, isOpen, open, close, port). Every command line written
+to it is answered with a <N>{"cmd":"X","data":...}</N>\\r\\n frame, N is the firmware
+command counter which is reset by the 'Z' command. With noise > 0 a fraction of
+the frames is corrupted by injected garbage or truncation. With baudrate set,
+responses only become readable after their transfer time, and bytes written past
+rx_buffer_size in a single write are lost like on the real MCU.
+
+Usage:
+  emulator.py bench [--frames=FRAMES] [--noise=NOISE] [--chunk=CHUNK]
+  emulator.py (-h | --help)
+
+Options:
+  -h, --help
+  --frames=FRAMES  [default: 100000]
+  --noise=NOISE    [default: 0.05]
+  --chunk=CHUNK    [default: 256]
+
+"""
+
+# Python
+import re
+import json
+import time
+import random
+import threading
+
+from framer import Framer
+
+##########################################################################################
+# Global definitions
+GARBAGE = 'abcdef0123456789{}[]",:<>/\x00\xff'
+
+
+class EmulatedComPort(object):
+
+    def __init__(self, port='/dev/emulated', noise=0.0, seed=None, firmware='ComPort',
+                 baudrate=None, rx_buffer_size=None):
+        self.port           = port
+        self.noise          = noise
+        self.firmware       = firmware
+        self.baudrate       = baudrate
+        self.rx_buffer_size = rx_buffer_size
+        self.closed         = False
+        self.counter        = 0
+        self.rx             = ''
+        self.tx             = ''
+        self.scheduled      = []
+        self.line_free_at   = 0.0
+        self.lock           = threading.Lock()
+        self.random         = random.Random(seed)
+
+    def isOpen(self):
+        return not self.closed
+
+    def open(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def _transmit(self, data):
+        """Queue data for the host, delayed by its transfer time when baudrate is set"""
+        if not self.baudrate:
+            self.tx += data
+            return
+        start = max(time.time(), self.line_free_at)
+        self.line_free_at = start + len(data) * 10.0 / self.baudrate
+        self.scheduled.append((self.line_free_at, data))
+
+    def _deliver(self):
+        now = time.time()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            self.tx += self.scheduled.pop(0)[1]
+
+    def inWaiting(self):
+        with self.lock:
+            self._deliver()
+            return len(self.tx)
+
+    def read(self, size=1):
+        with self.lock:
+            self._deliver()
+            data    = self.tx[:size]
+            self.tx = self.tx[size:]
+        return data
+
+    def write(self, data):
+        with self.lock:
+            if self.rx_buffer_size is not None:
+                data = data[:self.rx_buffer_size]
+            self.rx += data
+            lines = self.rx.split('\n')
+            self.rx = lines.pop()
+            for line in lines:
+                self._execute(line.strip())
+        return len(data)
+
+    def _execute(self, cmd):
+        if not cmd:
+            return
+        if cmd == 'Z':
+            self.counter = 0
+        self._transmit(self.corrupt(self.frame(cmd[0], self.respond(cmd))))
+
+    def respond(self, cmd):
+        """Data returned for cmd, override for specific firmware behaviour"""
+        if cmd[0] == 'I':
+            return self.firmware
+        return [[cmd, self.random.random()]]
+
+    def frame(self, cmd, data):
+        self.counter += 1
+        payload = json.dumps({'cmd' : cmd, 'data' : data}, separators=(',', ':'))
+        return '<{0}>{1}</{0}>\r\n'.format(self.counter, payload)
+
+    def corrupt(self, frame):
+        if self.noise <= 0 or self.random.random() >= self.noise:
+            return frame
+        garbage = ''.join(self.random.choice(GARBAGE) for i in range(self.random.randint(1, 16)))
+        how = self.random.randint(0, 2)
+        if how == 0:
+            return garbage + frame
+        elif how == 1:
+            cut = self.random.randint(1, len(frame) - 3)
+            return frame[:cut] + garbage + '\r\n'
+        else:
+            cut = self.random.randint(1, len(frame) - 3)
+            return frame[:cut] + garbage + frame[cut:]
+
+    def unsolicited(self, cmd, data):
+        """Queue a frame the MCU sends on its own, e.g. from a hardware interrupt"""
+        with self.lock:
+            self._transmit(self.corrupt(self.frame(cmd, data)))
+
+##########################################################################################
+# Benchmark of the framer against the legacy wipe-the-buffer decoder
+
+re_data = re.compile(r'(?:<)(?P<cmd>\d+)(?:>)(.*)(?:<\/)(?P=cmd)(?:>)', re.DOTALL)
+
+def legacy_decode(stream, chunk):
+    """Decoder used by SerialRedisCom before the framer, returns (raw frames, resets)"""
+    buffer = ''
+    frames = []
+    resets = 0
+    for i in range(0, len(stream), chunk):
+        buffer += stream[i:i + chunk]
+        crlf_index = buffer.find('\r\n')
+        while crlf_index > -1:
+            match = re_data.search(buffer[0:crlf_index])
+            if match:
+                frames.append(match.group(0))
+                buffer = buffer[crlf_index + 2:]
+            else:
+                buffer = ''
+                resets += 1
+            crlf_index = buffer.find('\r\n')
+    return frames, resets
+
+def framer_decode(stream, chunk):
+    """Returns (raw frames, resyncs, skipped bytes)"""
+    framer = Framer()
+    frames = []
+    for i in range(0, len(stream), chunk):
+        frames.extend(raw for cmd_number, payload, raw in framer.feed(stream[i:i + chunk]))
+        if framer.needs_resync():
+            framer.resynced()
+    return frames, framer.resyncs, framer.skipped_bytes
+
+def benchmark(frames=100000, noise=0.05, chunk=256, seed=0):
+    """
+    Decodes a noisy stream of frames with both decoders. Only frames identical to what the
+    firmware sent count as intact, corrupted frames a decoder let through count as bad
+    (e.g. garbage inside a json string, which no decoder can detect without a checksum).
+    """
+    port   = EmulatedComPort(noise=noise, seed=seed)
+    clean  = set()
+    stream = []
+    for i in range(frames):
+        frame = port.frame('T', [['28FF{0:04d}'.format(i % 16), 20.0 + i % 10]])
+        clean.add(frame.rstrip('\r\n'))
+        stream.append(port.corrupt(frame))
+    stream = ''.join(stream)
+
+    t0 = time.time()
+    legacy_frames, legacy_resets = legacy_decode(stream, chunk)
+    t1 = time.time()
+    framer_frames, framer_resyncs, skipped = framer_decode(stream, chunk)
+    t2 = time.time()
+
+    legacy_intact = len([raw for raw in legacy_frames if raw in clean])
+    framer_intact = len([raw for raw in framer_frames if raw in clean])
+    return {'sent'            : frames,
+            'noise'           : noise,
+            'bytes'           : len(stream),
+            'legacy_intact'   : legacy_intact,
+            'legacy_bad'      : len(legacy_frames) - legacy_intact,
+            'legacy_resets'   : legacy_resets,
+            'legacy_fps'      : len(legacy_frames) / max(t1 - t0, 1e-9),
+            'framer_intact'   : framer_intact,
+            'framer_bad'      : len(framer_frames) - framer_intact,
+            'framer_resyncs'  : framer_resyncs,
+            'framer_skipped'  : skipped,
+            'framer_fps'      : len(framer_frames) / max(t2 - t1, 1e-9)}
+
+############################################################################################
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    if arguments['bench']:
+        result = benchmark(int(arguments['--frames']), float(arguments['--noise']), int(arguments['--chunk']))
+        for key in sorted(result):
+            print('{0:16s} {1}'.format(key, result[key]))
@@ -0,0 +1,127 @@
+"""framer.py -
+
+Resynchronizing framer for the ComPort firmware output.
+
+The firmware sends frames of the form <N>{"cmd":"X",...}</N> followed by \\r\\n.
+Instead of discarding the whole buffer when a line does not decode, the framer
+scans forward to the next <N> frame start, keeps every complete frame it can find
+and counts the bytes it had to skip. A complete frame whose payload is not a json
+object with a "cmd" field was corrupted on the line and is counted as an error.
+The MCU only needs to be asked to resync (the 'Z' command) once the error rate
+over the last `window` events goes above `max_error_rate`.
+
+"""
+
+# Python
+import re
+import json
+from collections import deque
+
+##########################################################################################
+# Global definitions
+MAX_FRAME      = 4096
+WINDOW         = 50
+MAX_ERROR_RATE = 0.2
+WHITESPACE     = ' \t\r\n'
+
+
+class Framer(object):
+    re_start   = re.compile(r'<(\d+)>')
+    re_partial = re.compile(r'<\d*$')
+
+    def __init__(self, max_frame=MAX_FRAME, window=WINDOW, max_error_rate=MAX_ERROR_RATE):
+        self.max_frame      = max_frame
+        self.window         = window
+        self.max_error_rate = max_error_rate
+        self.buffer         = ''
+        self.history        = deque(maxlen=window)
+        self.frames         = 0
+        self.errors         = 0
+        self.skipped_bytes  = 0
+        self.resyncs        = 0
+
+    def _skip(self, garbage):
+        """Account for bytes that are not part of any frame, line endings are not errors"""
+        garbage = garbage.strip(WHITESPACE)
+        if garbage:
+            self.skipped_bytes += len(garbage)
+            self.errors        += 1
+            self.history.append(1)
+
+    def feed(self, data):
+        """
+        Appends data to the internal buffer and returns a list of (cmd_number, payload, raw)
+        tuples for every complete frame found. Incomplete trailing frames stay buffered.
+        """
+        buf    = self.buffer + data
+        pos    = 0      # everything before pos is consumed
+        scan   = 0      # where to look for the next start tag, pos <= scan
+        frames = []
+        while True:
+            start = self.re_start.search(buf, scan)
+            if start is None:
+                # keep a possibly incomplete start tag, everything else is garbage
+                partial = self.re_partial.search(buf, scan)
+                keep    = partial.start() if partial else len(buf)
+                self._skip(buf[pos:keep])
+                pos = keep
+                break
+
+            end_tag = '</{0}>'.format(start.group(1))
+            end     = buf.find(end_tag, start.end())
+            limit   = end if end > -1 else len(buf)
+            restart = self.re_start.search(buf, start.end(), limit)
+
+            if restart is not None:
+                # a new frame begins before this one was closed, the current one is truncated
+                self._skip(buf[pos:restart.start()])
+                pos = scan = restart.start()
+            elif end < 0:
+                if len(buf) - start.start() > self.max_frame:
+                    # too long to be a frame, the start tag is part of the garbage region
+                    scan = start.end()
+                    continue
+                self._skip(buf[pos:start.start()])
+                pos = start.start()
+                break
+            else:
+                payload = buf[start.end():end]
+                if self.valid_payload(payload):
+                    self._skip(buf[pos:start.start()])
+                    pos = scan = end + len(end_tag)
+                    frames.append((start.group(1), payload, buf[start.start():pos]))
+                    self.frames += 1
+                    self.history.append(0)
+                else:
+                    self._skip(buf[pos:end + len(end_tag)])
+                    pos = scan = end + len(end_tag)
+
+        self.buffer = buf[pos:]
+        return frames
+
+    def valid_payload(self, payload):
+        """The firmware always sends a json object with the echoed 'cmd' field"""
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return False
+        return isinstance(data, dict) and 'cmd' in data
+
+    def error_rate(self):
+        """Fraction of errors over the last `window` events, a partly filled window counts as clean"""
+        return sum(self.history) / float(self.window)
+
+    def needs_resync(self):
+        return self.error_rate() > self.max_error_rate
+
+    def resynced(self):
+        self.resyncs += 1
+        self.history.clear()
+
+    def stats(self):
+        return {'frames'        : self.frames,
+                'errors'        : self.errors,
+                'skipped_bytes' : self.skipped_bytes,
+                'resyncs'       : self.resyncs,
+                'error_rate'    : self.error_rate(),
+                'buffered'      : len(self.buffer)}
@@ -0,0 +1,102 @@
+"""profiler.py -
+
+Low overhead sampling profiler for the running gateway threads.
+
+The sampler wakes up every `interval` seconds, grabs the current stack of every
+watched thread with sys._current_frames() and counts identical stacks. Results
+are written in the collapsed stack format (one "frame;frame;frame count" line per
+stack) which can be fed directly to flamegraph.pl or speedscope.
+
+"""
+
+# Python
+import os
+import sys
+import time
+import tempfile
+import threading
+from collections import defaultdict
+
+##########################################################################################
+# Global definitions
+INTERVAL     = 0.005
+MAX_DURATION = 300.0
+OUTPUT_DIR   = tempfile.gettempdir()
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{0}:{1}:{2}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno)
+
+
+class SamplingProfiler(object):
+    """
+    Samples stacks of the given threads (all threads except its own when threads is None)
+    for `duration` seconds in a background daemon thread.
+    """
+
+    def __init__(self, threads=None, interval=INTERVAL):
+        self.threads  = threads
+        self.interval = interval
+        self.samples  = defaultdict(int)
+        self.count    = 0
+        self.running  = False
+        self.thread   = None
+
+    def _thread_names(self):
+        if self.threads is None:
+            return dict((t.ident, t.name) for t in threading.enumerate())
+        return dict((t.ident, t.name) for t in self.threads if t is not None and t.ident)
+
+    def sample(self):
+        names  = self._thread_names()
+        frames = sys._current_frames()
+        me     = threading.current_thread().ident
+        for ident, frame in frames.items():
+            if ident == me or ident not in names:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names[ident])
+            self.samples[';'.join(reversed(stack))] += 1
+        self.count += 1
+
+    def run(self, duration):
+        """Samples until duration seconds passed or stop() was called, start() sets running"""
+        stop_at = time.time() + duration
+        while self.running and time.time() < stop_at:
+            self.sample()
+            time.sleep(self.interval)
+        self.running = False
+
+    def start(self, duration, callback=None):
+        """Start sampling in a daemon thread, callback(self) is invoked when finished"""
+        # set before the thread runs so a second start request sees the session right away
+        self.running = True
+
+        def target():
+            self.run(duration)
+            if callback is not None:
+                callback(self)
+        self.thread = threading.Thread(target=target, name='profiler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def collapsed(self):
+        return '\n'.join('{0} {1}'.format(stack, count) for stack, count in sorted(self.samples.items()))
+
+    def write(self, path=None, prefix='profile'):
+        """Write collapsed stacks to path (a new file in OUTPUT_DIR by default), returns the path"""
+        if path is None:
+            name = '{0}-{1}-{2}.collapsed'.format(prefix, os.getpid(), time.strftime('%Y%m%d-%H%M%S'))
+            path = os.path.join(OUTPUT_DIR, name)
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+            f.write('\n')
+        return path
@@ -0,0 +1,118 @@
+"""routing.py -
+
+Topic partitioned fan-out of decoded frames.
+
+Instead of sending every frame to the single 'data' channel, TopicRouter publishes
+each frame to hierarchical channels built from templates, e.g.
+
+  data.{signature}.{cmd}        ->  data.192_168_1_10:/dev/ttyUSB0.T
+  data.{signature}.{sensor}     ->  data.192_168_1_10:/dev/ttyUSB0.28FF0001  (one per sensor)
+
+so consumers can subscribe to exactly the frames they need, or use pattern
+subscriptions such as 'data.*.T'. Template fields are signature, cmd, sensor
+(ids found in the payload data) and any scalar top level payload key. cmd_number
+is not a field, it changes with every frame. Templates referencing a field the
+frame does not have are skipped. Publishing to the legacy 'data' channel is opt-in.
+Publish counts are kept for the first MAX_CHANNELS channels, the rest are summed
+up under OTHER.
+
+"""
+
+# Python
+import re
+import json
+import threading
+import itertools
+from string import Formatter
+from collections import defaultdict
+
+##########################################################################################
+# Global definitions
+TEMPLATES      = ('data.{signature}.{cmd}',)
+LEGACY_CHANNEL = 'data'
+MAX_CHANNELS   = 1024
+OTHER          = '*other*'
+
+re_unsafe = re.compile(r'[.\s*?\[\]]')
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+def sanitize(value):
+    """Channel names are '.' separated, keep field values from adding levels or glob characters"""
+    return re_unsafe.sub('_', str(value))
+
+def payload_fields(payload):
+    """Returns the template fields found in the json payload of a frame"""
+    if not isinstance(payload, dict):
+        try:
+            payload = json.loads(payload)
+        except (TypeError, ValueError):
+            return dict()
+    if not isinstance(payload, dict):
+        return dict()
+
+    fields = dict((key, value) for key, value in payload.items()
+                  if isinstance(value, (string_types, int, float)) and not isinstance(value, bool))
+
+    data = payload.get('data')
+    if isinstance(data, dict):
+        fields['sensor'] = list(data.keys())
+    elif isinstance(data, list):
+        sensors = [item[0] for item in data if isinstance(item, (list, tuple)) and len(item) >= 2]
+        if sensors:
+            fields['sensor'] = sensors
+    return fields
+
+
+class TopicRouter(object):
+
+    def __init__(self, templates=TEMPLATES, legacy=False, legacy_channel=LEGACY_CHANNEL, max_channels=MAX_CHANNELS):
+        self.templates      = list(templates)
+        self.legacy         = legacy
+        self.legacy_channel = legacy_channel
+        self.max_channels   = max_channels
+        self.counts         = defaultdict(int)
+        self.lock           = threading.Lock()
+        self._names         = dict((t, [f[1] for f in Formatter().parse(t) if f[1]]) for t in self.templates)
+        for template, names in self._names.items():
+            if 'cmd_number' in names:
+                raise ValueError('{}: cmd_number would create a channel per frame'.format(template))
+
+    def channels(self, signature, final_data):
+        """Returns the list of channels final_data (as built by SerialRedisCom) is published to"""
+        fields = payload_fields(final_data.get('data'))
+        fields['signature'] = signature
+
+        channels = []
+        for template in self.templates:
+            names = self._names[template]
+            if any(fields.get(name) is None for name in names):
+                continue
+            values = [fields[name] if isinstance(fields[name], list) else [fields[name]] for name in names]
+            for combination in itertools.product(*values):
+                channel = template.format(**dict(zip(names, map(sanitize, combination))))
+                if channel not in channels:
+                    channels.append(channel)
+
+        if self.legacy:
+            channels.append(self.legacy_channel)
+        return channels
+
+    def publish(self, transport, signature, final_data, message):
+        """Publishes message to every channel of final_data, returns the list of channels"""
+        channels = self.channels(signature, final_data)
+        for channel in channels:
+            transport.publish(channel, message)
+        with self.lock:
+            for channel in channels:
+                if channel not in self.counts and len(self.counts) >= self.max_channels:
+                    channel = OTHER
+                self.counts[channel] += 1
+        return channels
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
@@ -5,7 +5,7 @@ Simple module for communicating with ComPort firmware written for AVR328p.
 Usage:
   hardware.py test [--dev=DEV ] [--test] [--submit_to=SUBMIT_TO] [--redishost=REDISHOST]
   hardware.py 1wire [--dev=DEV ] [--test] [--submit_to=SUBMIT_TO] [--redishost=REDISHOST]
-  hardware.py run [--dev=DEV] [--local] [--submit_to=SUBMIT_TO] [--redishost=REDISHOST]
+  hardware.py run [--dev=DEV] [--local] [--legacy] [--submit_to=SUBMIT_TO] [--redishost=REDISHOST]
   hardware.py (-h | --help)
 
 Options:
@@ -23,6 +23,9 @@ import time
 import re
 import json
 import sys
+import logging
+import itertools
+import uuid
 from time import sleep
 from datetime import datetime
 import subprocess
@@ -30,11 +33,15 @@ from json import dumps, loads
 
 # pip install
 import serial
-import redis
 
 from docopt import docopt
 from redislog import handlers, logger    # pip install python-redis-log
 
+from framer import Framer
+from profiler import SamplingProfiler, MAX_DURATION
+from routing import TopicRouter
+from transport import LocalBroker, get_transport
+
 ##########################################################################################
 # Global definitions
 TIMEOUT  = 2
@@ -79,6 +86,13 @@ class Message(object):
         self.msg       = data_dict['MSG']
         return data_dict
 
+def echoed_cmd(payload):
+    """Returns the "cmd" field the firmware echoes in its json payload, '' if there is none"""
+    try:
+        return loads(payload).get('cmd', '')
+    except (TypeError, ValueError, AttributeError):
+        return ''
+
 ##########################################################################################
 # This class opens connection to a serial port using a reader thread.  The reader thread monitors incomming
 # message on the serial line.  As soon as \n\r is detected the line is read and decoded.  The line read is published to -read redis channel
@@ -89,35 +103,65 @@ class SerialRedisCom(object):
     decode_json       = True
     redis_pub_channel = 'data'
     clear_after_error = True
+    ctl_prefix        = '!'
     next_cmd_num      = -1
     state             = dict()
+    rx_buffer_size    = 64      # bytes, serial RX buffer of the AVR Arduino core
+    poll_interval     = 0.01    # seconds the reader sleeps when no bytes are waiting
+    drain_timeout     = 0.5     # seconds query_many waits for responses to earlier commands
 
     def __init__(self,
                  port = '/dev/ttyUSB0',baudrate=115200,       
                  packet_timeout=1,bytesize=8,parity='N',stopbits=1,xonxoff=0,rtscts=0,writeTimeout=None,dsrdtr=None,
                  host='127.0.0.1',
-                 run=True):
+                 run=True,
+                 transport=None,
+                 local=False,
+                 max_error_rate=0.2,
+                 router=None):
         
         self.buffer         = ''
         self.last_read_line = ''        
+        self.framer         = Framer(max_error_rate=max_error_rate)
+        # frames are published to data.<signature>.<cmd> by default, see routing.py
+        self.router         = router if router is not None else TopicRouter(legacy_channel=self.redis_pub_channel)
 
         self.serial    = serial.Serial(port, baudrate, bytesize, parity, stopbits, packet_timeout, xonxoff, rtscts, writeTimeout, dsrdtr)
         self.signature = "{0:s}:{1:s}".format(get_host_ip(), self.serial.port)
         
-        self.redis = redis.Redis(host=host)
+        # transport is anything with the redis client API used here, LocalBroker for --local
+        if transport is None:
+            transport = get_transport(local, host)
+        self.redis = transport
+        self.local = isinstance(transport, LocalBroker)
         self.redis_send_key = self.signature+'-send'
         self.redis_read_key = self.signature+'-read'
+        self.redis_ctl_key  = self.signature+'-ctl'
+        self.profiler       = None
+
+        self.last_cmd_number = -1
+        self.in_flight       = 0
+        self.response_cond   = threading.Condition()
+        self._batch          = None
+        # cmd_number restarts after a resync or reset, frame_id names a frame for its consumers
+        self.session         = uuid.uuid4().hex[:8]
+        self.frame_ids       = itertools.count()
                 
         logger_name = 'sermon.py:{}'.format(self.signature)
-        if sys.stdout.isatty():        
-        #    self.log   = Logger(logger_name)
-        #else:            
+        if self.local:
+            self.log   = logging.getLogger(logger_name)
+        elif sys.stdout.isatty():        
             self.log   = logger.RedisLogger(logger_name)
             self.log.addHandler(handlers.RedisHandler.to("log", host='localhost', port=6379))
+        else:
+            # detached (systemd, nohup, supervisor workers), log through the root handlers
+            self.log   = logging.getLogger(logger_name)
 
         self.log.level     = 1
         self.alive         = False
         self._reader_alive = False
+        self.connected     = True
+        self.bytes_read    = 0
 
         # TODO add checking for redis presence and connection
         if self.redis.ping():
@@ -199,7 +243,10 @@ class SerialRedisCom(object):
                         break
                     else:
                         cmd = item['data']
-                        if isinstance(cmd,str):
+                        if isinstance(cmd,str) and cmd.startswith(self.ctl_prefix):
+                            self.log.debug(cmd)
+                            self.control(cmd[len(self.ctl_prefix):])
+                        elif isinstance(cmd,str):
                             self.log.debug(cmd)
                             self.send(item['data'])
                         else:
@@ -211,9 +258,100 @@ class SerialRedisCom(object):
         self.pubsub.unsubscribe()      
         self.log.debug('end of cmd_via_redis_subscriber()')
 
+    def control(self, cmd):
+        """
+        Handles gateway control commands, i.e. commands sent to the device channel prefixed with
+        ctl_prefix. These are not forwarded to the serial port. The reply is published to and
+        stored under redis_ctl_key.
+
+          !profile [seconds]  - sample the reader, subscriber and publisher threads
+          !stats              - framer statistics and per channel publish counts
+        """
+        args = cmd.split()
+        if not args:
+            return
+        name = args[0]
+        if name == 'profile':
+            try:
+                duration = float(args[1]) if len(args) > 1 else 10.0
+            except ValueError:
+                duration = 0
+            if not duration > 0:
+                self.reply({'cmd' : name, 'error' : 'invalid duration {}'.format(args[1])})
+                return
+            self.start_profiler(min(duration, MAX_DURATION))
+        elif name == 'stats':
+            self.reply({'cmd' : name, 'framer' : self.framer.stats(), 'publish_counts' : self.router.stats()})
+        else:
+            self.reply({'cmd' : name, 'error' : 'unknown control command'})
+
+    def reply(self, msg):
+        Msg = Message(self.signature, msg=msg)
+        self.redis.set(self.redis_ctl_key, Msg.as_json())
+        self.redis.publish(self.redis_ctl_key, Msg.as_json())
+
+    def start_profiler(self, duration):
+        """
+        Samples the gateway threads for duration seconds (at most MAX_DURATION) without
+        interrupting them, the path of the collapsed stack file is reported via reply().
+        """
+        if self.profiler is not None and self.profiler.running:
+            self.reply({'cmd' : 'profile', 'error' : 'profiler already running'})
+            return
+        duration = min(duration, MAX_DURATION)
+        threads  = [getattr(self, 'receiver_thread', None), getattr(self, 'redis_subscriber_thread', None)]
+        self.profiler = SamplingProfiler(threads)
+        self.log.info('start_profiler(duration={})'.format(duration))
+
+        def done(profiler):
+            path = profiler.write(prefix='profile-{}'.format(re.sub(r'[^\w.-]', '_', self.signature)))
+            self.log.info('profile written to {}'.format(path))
+            self.reply({'cmd' : 'profile', 'path' : path, 'samples' : profiler.count})
+
+        self.profiler.start(duration, done)
+        self.reply({'cmd' : 'profile', 'status' : 'started', 'duration' : duration})
+
     def stop(self):
         # 
         self.alive = False
+
+    def reconnect(self, port=None):
+        '''
+        Reopens the serial port and restarts the reader thread, used after the device was
+        unplugged and came back, possibly as a different tty given by port.
+        Returns True when the port is open again.
+        '''
+        self.log.info('reconnect({})'.format(port or self.serial.port))
+        if self.receiver_thread.is_alive():
+            self._stop_reader()
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        try:
+            if port is not None:
+                self.serial.port = port
+            self.serial.open()
+        except Exception as E:
+            self.log.error('reconnect() failed: {}'.format(E))
+            self.connected = False
+            return False
+
+        self.framer.buffer = ''
+        self.buffer        = ''
+        self.connected     = True
+        with self.response_cond:
+            self.in_flight = 0
+        self._start_reader()
+        return True
+
+    def health(self):
+        return {'connected'     : self.connected and self.receiver_thread.is_alive(),
+                'bytes'         : self.bytes_read,
+                'frames'        : self.framer.frames,
+                'errors'        : self.framer.errors,
+                'skipped_bytes' : self.framer.skipped_bytes,
+                'resyncs'       : self.framer.resyncs}
         
     def open(self):
         if not self.serial.isOpen():
@@ -240,6 +378,8 @@ class SerialRedisCom(object):
             try:
                 self.serial.write(data)
                 serial_error = 0
+                with self.response_cond:
+                    self.in_flight += data.count('\n')
             except:
                 serial_error = 1
         else:
@@ -297,6 +437,102 @@ class SerialRedisCom(object):
                 query_data[0] = False
         return query_data
 
+    def query_many(self, cmds, timeout=TIMEOUT, settle=0):
+        """
+        Sends all cmds in bursts limited by rx_buffer_size and gathers the responses by their
+        cmd_number. Returns a [done, final_data] pair for every command in the order of cmds,
+        done is False (and final_data None) for commands that were not answered within timeout.
+
+        The firmware numbers every frame it sends, so an unsolicited frame arriving during the
+        batch shifts the numbering. A response with an unexpected number or echo marks the
+        whole batch as suspect and every result is reported with done False.
+
+        An unsolicited frame sent before the first response can shift every number of the
+        batch by one while each echo still matches, with the last real response arriving
+        after the batch looked complete. settle > 0 keeps watching for such a late frame for
+        settle seconds, at the cost of adding settle to every call. A few frame transfer
+        times (about 4 ms per 50 byte frame at 115200 baud) are enough. The default 0 returns
+        as soon as the last response arrived.
+        """
+        cmds    = [cmd.rstrip('\n') for cmd in cmds]
+        results = [[False, None] for cmd in cmds]
+        if not cmds:
+            return results
+
+        drain_until = time.time() + self.drain_timeout
+        with self.response_cond:
+            # responses to earlier commands would shift the cmd_number base, let them drain first
+            while self.in_flight and time.time() < drain_until and self.alive and self._reader_alive:
+                self.response_cond.wait(max(0, min(0.1, drain_until - time.time())))
+            if self.in_flight:
+                self.log.debug('query_many() {} earlier responses never arrived'.format(self.in_flight))
+                self.in_flight = 0
+            self._batch = []
+            base        = self.last_cmd_number
+
+        pending   = set()
+        in_flight = 0
+        sent      = 0
+        suspect   = False
+        stop_at   = time.time() + timeout
+        settle_at = None
+        try:
+            while time.time() < stop_at:
+                if sent == len(cmds) and not pending:
+                    # the batch is complete, a late response means the numbering was shifted
+                    if settle_at is None:
+                        settle_at = time.time() + settle
+                    if time.time() >= settle_at:
+                        break
+
+                burst = []
+                while sent < len(cmds) and (in_flight + len(cmds[sent]) + 1 <= self.rx_buffer_size or not (pending or burst)):
+                    burst.append(cmds[sent] + '\n')
+                    pending.add(sent)
+                    in_flight += len(cmds[sent]) + 1
+                    sent      += 1
+                if burst:
+                    self.send(''.join(burst), CR=False)
+
+                if not (self.alive and self._reader_alive):
+                    self.read_serial_data()
+                with self.response_cond:
+                    if not self._batch and self.alive and self._reader_alive:
+                        wait_until = settle_at if settle_at is not None else stop_at
+                        self.response_cond.wait(max(0, min(0.1, wait_until - time.time())))
+                    arrivals, self._batch = self._batch, []
+
+                for final_data in arrivals:
+                    number = int(final_data['cmd_number'])
+                    echo   = echoed_cmd(final_data['data'])
+                    if base < 0:
+                        # counter unknown, the first response echoing cmds[0] sets it
+                        if 0 in pending and echo and cmds[0].startswith(echo):
+                            base = number - 1
+                        else:
+                            continue
+                    i = number - base - 1
+                    if i not in pending or not (echo and cmds[i].startswith(echo)):
+                        suspect = True
+                        continue
+                    pending.discard(i)
+                    in_flight -= len(cmds[i]) + 1
+                    results[i] = [True, final_data]
+                if suspect:
+                    break
+        finally:
+            with self.response_cond:
+                self._batch = None
+
+        if suspect:
+            self.log.error('query_many() unexpected response, results of {} can not be trusted'.format(cmds))
+            for result in results:
+                result[0] = False
+        failed = [cmds[i] for i, result in enumerate(results) if not result[0]]
+        if failed:
+            self.log.debug('query_many() no valid response for {}'.format(failed))
+        return results
+
     def close(self):
         '''
         Close the listening thread.
@@ -314,7 +550,6 @@ class SerialRedisCom(object):
         
         try:
             self.log.debug('Starting the listner thread')
-            Msg = Message(self.signature)
 
             while self.alive and self._reader_alive:
                 """
@@ -325,112 +560,79 @@ class SerialRedisCom(object):
                 self.state['bytes_in_waiting'] = bytes_in_waiting
                 
                 if bytes_in_waiting:
-                    new_data    = self.serial.read(bytes_in_waiting)
-                    self.buffer = self.buffer + new_data
-
-                    self.state['buffer'] = self.buffer 
-                
-                    crlf_index = self.buffer.find('\r\n')
-                    
-                    if crlf_index > -1:
-                        self.log.debug('Found crlf in the buffer')
-                        line = self.buffer[0:crlf_index]                    
-                        self.last_read_line = line   
-                        self.state['line'] = line 
-                        
-                        self.log.debug('read line: ' + line)
-
-                        if self.decode_json:
-                            self.log.debug('decode_json')
-                            temp = self.re_data.findall(line)
-                            self.state['decode_json'] = temp 
-
-                            if len(temp):
-                                final_data = dict()
-                                timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
-                                final_data['timestamp'] = timestamp
-                                final_data['raw']       = line
-                                
-                                try:                                    
-                                    final_data.update({'cmd_number' : temp[0][0]})
-                                    final_data.update({'data' : temp[0][1]})
-                                    self.log.debug('succesfully decoded json data, updated final_data')
-
-                                except Exception as E:
-                                    final_data.update({'cmd_number' : -1})
-                                    final_data.update({'data' : [[]]})
-                                    error_msg = {'timestamp' : timestamp, 'from': self.signature, 'source' : 'ComPort', 'function' : 'def run() - inner', 'error' : E.message}
-                                    Msg.msg = error_msg
-                                    self.log.error(Msg.msg)
-
-                                Msg.msg = final_data
-                                self.state['final_data'] = final_data 
-                                self.last_msg = Msg
-                                self.log.debug("final_data={}".format(final_data))
-                                
-                                self.redis.publish(self.redis_pub_channel, Msg.as_jsno())                        
-                                self.redis.set(self.redis_read_key,Msg.as_jsno())
-                                self.buffer = self.buffer[crlf_index+2:]
-                            else:                                
-                                if self.clear_after_error:
-                                    self.buffer = ''
-                                    self.send('Z')
-                                    self.log.debug('reseting command number')
-                                pass
+                    self.process_serial_data(self.serial.read(bytes_in_waiting))
                 else:
-                    sleep(0.1)
+                    sleep(self.poll_interval)
 
         except Exception as E:
+            # most often the device went away (e.g. unplugged), reconnect() brings the reader back.
+            # Release the tty, a held dead tty makes the re-plugged adapter come back under a new name
+            self.connected = False
+            self.state['error'] = str(E)
+            try:
+                self.serial.close()
+            except Exception:
+                pass
             error_msg = {'source' : 'ComPort', 'function' : 'def run() - outter', 'error' : E.message}
             self.log.error("Exception occured, within the run function: %s" % E.message)
         
         self.log.debug('Exiting run() function')
 
     def read_serial_data(self):
-
-        Msg = Message(self.signature)
         bytes_in_waiting = self.serial.inWaiting()                
         
         if bytes_in_waiting:
-            new_data = self.serial.read(bytes_in_waiting)
-            self.buffer = self.buffer + new_data
+            self.process_serial_data(self.serial.read(bytes_in_waiting))
         else:
-            sleep(0.1)
+            sleep(self.poll_interval)
+
+    def process_serial_data(self, new_data):
+        '''
+        Feeds new_data to the framer and publishes every complete frame. Garbage between frames is
+        skipped by the framer, the MCU is only asked to resync once the error rate gets too high.
+        '''
+        self.bytes_read += len(new_data)
+        frames      = self.framer.feed(new_data)
+        self.buffer = self.framer.buffer
+        self.state['buffer'] = self.buffer
+
+        for cmd_number, payload, raw in frames:
+            self.last_read_line = raw
+            self.state['line']  = raw
+            self.log.debug('read line: ' + raw)
+
+            final_data = dict()
+            timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+            final_data['timestamp']  = timestamp
+            final_data['raw']        = raw
+            final_data['cmd_number'] = cmd_number
+            final_data['data']       = payload
+            final_data['frame_id']   = '{0}-{1}'.format(self.session, next(self.frame_ids))
+
+            with self.response_cond:
+                self.last_cmd_number = int(cmd_number)
+                self.in_flight       = max(0, self.in_flight - 1)
+                if self._batch is not None:
+                    self._batch.append(final_data)
+                self.response_cond.notify_all()
+
+            Msg = Message(self.signature, msg=final_data)
+            self.state['final_data'] = final_data 
+            self.last_msg = Msg
+            self.log.debug("final_data={}".format(final_data))
+
+            self.router.publish(self.redis, self.signature, final_data, Msg.as_jsno())
+            self.redis.set(self.redis_read_key,Msg.as_jsno())
+
+        self.state['framer']         = self.framer.stats()
+        self.state['publish_counts'] = self.router.stats()
+        if self.clear_after_error and self.framer.needs_resync():
+            self.log.debug('error rate {:.2f} too high, reseting command number'.format(self.framer.error_rate()))
+            self.framer.resynced()
+            with self.response_cond:
+                self.in_flight = 0
+            self.send('Z')
 
-        crlf_index = self.buffer.find('\r\n')
-
-        if crlf_index > -1:
-            self.last_read_line = self.buffer[0:crlf_index]            
-            temp = self.re_data.findall(self.last_read_line)
-            self.log.debug('read self.last_read_line: ' + self.last_read_line)
-
-            if len(temp):
-                final_data = dict()
-                timestamp = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
-                final_data['timestamp'] = timestamp
-                final_data['raw']       = self.last_read_line
-                try:
-                    final_data.update({'cmd_number' : sjson.loads(temp[0][0])})
-                    final_data.update(sjson.loads(temp[0][1]))
-                    self.log.debug('.....updated final_data')
-
-                except Exception as E:
-                    final_data.update({'cmd_number' : -1})
-                    error_msg = {'timestamp' : timestamp, 'from': self.signature, 'source' : 'ComPort', 'function' : 'def run() - inner', 'error' : E.message}
-                    Msg.msg = error_msg
-                    self.log.error(Msg.msg)
-
-                Msg.msg = final_data
-                self.log.debug("final_data={}".format(final_data))
-                self.redis.publish(self.redis_pub_channel, Msg.as_jsno())
-                self.redis.set(self.redis_read_key,Msg.as_jsno())
-                self.buffer = self.buffer[crlf_index+2:]
-            else:
-                self.buffer = ''
-                self.send('Z')
-                self.log.debug('.....reseting command number')
-                pass
-            
 class SimpleCom(object):
     
     def __init__(self,
@@ -447,6 +649,8 @@ class SimpleCom(object):
         if sys.stdout.isatty():
             self.log   = logger.RedisLogger(logger_name)
             self.log.addHandler(handlers.RedisHandler.to("log", host='localhost', port=6379))
+        else:
+            self.log   = logging.getLogger(logger_name)
 
         self.log.level = 1
 
@@ -523,12 +727,18 @@ class SimpleCom(object):
 ############################################################################################
 
 def main(**kwargs):
+    com = None
+    if kwargs.get('run'):
+        com = SerialRedisCom(port=kwargs['--dev'], host=kwargs['--redishost'], local=kwargs.get('--local', False),
+                             router=TopicRouter(legacy=kwargs.get('--legacy', False)))
     try:
         while True:
             sleep(0.1)
             pass
     except KeyboardInterrupt:
         pass    
+    if com is not None:
+        com.close()
 
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    main(**docopt(__doc__))
\ No newline at end of file
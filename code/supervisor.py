@@ -0,0 +1,374 @@
+"""supervisor.py -
+
+Multi-process sharded gateway.
+
+The serial ports are spread round robin over worker processes (one shard per
+core by default), each worker runs a SerialRedisCom per port so parsing,
+decoding and publishing of different shards do not compete for the same GIL.
+Workers can optionally be pinned to a CPU. The supervisor restarts crashed
+workers, watches /dev with inotify (falling back to polling) and tells the
+owning shard to reopen a device as soon as it reappears. Devices are followed
+by their /dev/serial/by-id link and their USB serial number plus interface
+number, so an adapter that is re-plugged under another tty name is reopened on
+its new tty. Every shard reports health and throughput of its ports to the
+supervisor over a queue.
+
+Usage:
+  supervisor.py [--dev=DEV...] [--shards=SHARDS] [--affinity] [--redishost=REDISHOST] [--interval=INTERVAL]
+  supervisor.py (-h | --help)
+
+Options:
+  -h, --help
+  --dev=DEV              Port to serve, repeat for more, discovered when omitted
+  --shards=SHARDS        Number of worker processes [default: 0]
+  --affinity             Pin every worker to its own CPU
+  --redishost=REDISHOST  [default: 127.0.0.1]
+  --interval=INTERVAL    Seconds between health reports [default: 1.0]
+
+"""
+
+# Python
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from discovery import PATTERNS, candidate_ports, stable_port, device_key
+
+##########################################################################################
+# Global definitions
+REPORT_INTERVAL = 1.0
+RESTART_DELAY   = 1.0
+TICK            = 0.05
+WATCH_DIR       = '/dev'
+
+IN_ATTRIB     = 0x00000004
+IN_MOVED_TO   = 0x00000080
+IN_CREATE     = 0x00000100
+IN_NONBLOCK   = 0x00000800
+EVENT_HEADER  = struct.Struct('iIII')
+CPU_SETSIZE   = 1024
+
+log = logging.getLogger('supervisor.py')
+
+def shard_ports(ports, shards):
+    """Round robin assignment of ports to shards, returns a list of port lists"""
+    shards = max(1, min(shards, len(ports)))
+    return [list(ports[i::shards]) for i in range(shards)]
+
+def load_libc():
+    libc_name = ctypes.util.find_library('c')
+    return ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+
+def libc_set_affinity(cpu):
+    """sched_setaffinity(2) through ctypes, Python 2 has no os.sched_setaffinity"""
+    libc = load_libc()
+    if libc is None or not hasattr(libc, 'sched_setaffinity'):
+        return False
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // bits))()
+    mask[cpu // bits] = 1 << (cpu % bits)
+    return libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) == 0
+
+def set_affinity(cpu):
+    """Pins the calling process to cpu, returns False when the platform does not allow it"""
+    cpu = cpu % multiprocessing.cpu_count()
+    if hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, set([cpu]))
+            return True
+        except OSError:
+            return False
+    return libc_set_affinity(cpu)
+
+
+class DevWatcher(object):
+    """
+    Reports paths of watched devices that (re)appeared, and new ttys matching patterns which
+    may be a watched device that came back under another name. Uses inotify on WATCH_DIR
+    when libc provides it, otherwise polls for existence of the watched paths.
+    """
+
+    def __init__(self, paths, directory=WATCH_DIR, patterns=PATTERNS):
+        self.paths     = set(paths)
+        self.directory = directory
+        self.patterns  = patterns
+        self.present   = dict((path, os.path.exists(path)) for path in self.paths)
+        self.ttys      = set(candidate_ports(patterns))
+        self.fd        = None
+
+        libc = load_libc()
+        if libc is not None and hasattr(libc, 'inotify_init1'):
+            fd = libc.inotify_init1(IN_NONBLOCK)
+            if fd >= 0 and libc.inotify_add_watch(fd, directory.encode(), IN_CREATE | IN_ATTRIB | IN_MOVED_TO) >= 0:
+                self.fd = fd
+            elif fd >= 0:
+                os.close(fd)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _names(self, timeout):
+        """Names of entries created or changed in the directory within timeout seconds"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as E:
+            if E.errno == errno.EAGAIN:
+                return []
+            raise
+        names = []
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            names.append(data[pos:pos + length].rstrip(b'\0').decode())
+            pos += length
+        return names
+
+    def poll(self, timeout=TICK):
+        """Returns the list of watched paths and new ttys that appeared, waits at most timeout seconds"""
+        if self.fd is not None:
+            changed = set(os.path.join(self.directory, name) for name in self._names(timeout))
+        else:
+            time.sleep(timeout)
+            changed = self.paths
+
+        appeared = []
+        for path in self.paths:
+            exists = os.path.exists(path)
+            if exists and (not self.present[path] or path in changed):
+                appeared.append(path)
+            self.present[path] = exists
+
+        ttys = set(candidate_ports(self.patterns))
+        appeared.extend(sorted(ttys - self.ttys - self.paths))
+        self.ttys = ttys
+        return appeared
+
+
+def worker(shard, ports, status_queue, cmd_queue, cpu=None, report_interval=REPORT_INTERVAL, **kwargs):
+    """
+    Runs a SerialRedisCom for every port of the shard. Ports that can not be opened, or whose
+    reader died, are reopened when the supervisor says the device is back or on the next report.
+    """
+    from serialcom import SerialRedisCom
+
+    if cpu is not None and not set_affinity(cpu):
+        log.warning('shard {0}: can not pin to cpu {1}, running unpinned'.format(shard, cpu))
+
+    coms = dict()
+
+    def connect(port, path=None):
+        com = coms.get(port)
+        try:
+            if com is None:
+                coms[port] = SerialRedisCom(port=path or port, **kwargs)
+            elif not com.health()['connected']:
+                com.reconnect(path)
+        except Exception as E:
+            log.error('shard {0}: can not open {1}: {2}'.format(shard, port, E))
+
+    for port in ports:
+        connect(port)
+
+    next_report = time.time()
+    while True:
+        try:
+            cmd, port, path = cmd_queue.get(timeout=TICK)
+        except queue.Empty:
+            cmd = None
+        if cmd == 'stop':
+            break
+        elif cmd == 'reopen' and port in ports:
+            connect(port, path)
+
+        if time.time() >= next_report:
+            next_report += report_interval
+            health = dict()
+            for port in ports:
+                com = coms.get(port)
+                health[port] = com.health() if com is not None else {'connected' : False}
+                if not health[port]['connected'] and os.path.exists(com.serial.port if com is not None else port):
+                    connect(port)
+            status_queue.put({'shard' : shard, 'pid' : os.getpid(), 'time' : time.time(), 'ports' : health})
+
+    for com in coms.values():
+        com.close()
+
+
+class Supervisor(object):
+
+    def __init__(self, ports, shards=None, affinity=False, report_interval=REPORT_INTERVAL, **kwargs):
+        if kwargs.get('local') or kwargs.get('transport') is not None:
+            raise ValueError('workers run in separate processes, an in-process transport can not be shared')
+        ports                = [stable_port(port) for port in ports]
+        self.shards          = shard_ports(ports, shards or multiprocessing.cpu_count())
+        self.affinity        = affinity
+        self.report_interval = report_interval
+        self.kwargs          = kwargs
+        self.status_queue    = multiprocessing.Queue()
+        self.cmd_queues      = [multiprocessing.Queue() for shard in self.shards]
+        self.processes       = [None] * len(self.shards)
+        self.started_at      = [0.0] * len(self.shards)
+        self.restarts        = [0] * len(self.shards)
+        self.status          = dict()
+        self.previous        = dict()
+        self.rates           = dict()
+        self.owner           = dict((port, n) for n, ports in enumerate(self.shards) for port in ports)
+        self.device_keys     = self._device_keys(ports)
+        self.watcher         = None
+        self.running         = False
+
+    def _device_keys(self, ports):
+        """Maps device_key() to port, ports whose key is missing or not unique are followed by path only"""
+        keys       = dict()
+        duplicates = set()
+        for port in ports:
+            key = device_key(port)
+            if key is None:
+                continue
+            if key in keys or key in duplicates:
+                log.warning('{0} shares the device key {1} with another port, not followed to a new tty'.format(port, key))
+                duplicates.add(key)
+                keys.pop(key, None)
+            else:
+                keys[key] = port
+        return keys
+
+    def _spawn(self, n):
+        kwargs = dict(self.kwargs)
+        kwargs.update({'cpu' : n if self.affinity else None, 'report_interval' : self.report_interval})
+        process = multiprocessing.Process(target=worker, name='shard-{}'.format(n),
+                                          args=(n, self.shards[n], self.status_queue, self.cmd_queues[n]),
+                                          kwargs=kwargs)
+        process.daemon = True
+        process.start()
+        self.processes[n]  = process
+        self.started_at[n] = time.time()
+        log.info('started shard {0} pid {1} ports {2}'.format(n, process.pid, self.shards[n]))
+
+    def start(self):
+        self.running = True
+        self.watcher = DevWatcher(self.owner.keys())
+        for n in range(len(self.shards)):
+            self._spawn(n)
+
+    def stop(self):
+        self.running = False
+        for n, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                self.cmd_queues[n].put(('stop', None, None))
+        for process in self.processes:
+            if process is not None:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+        if self.watcher is not None:
+            self.watcher.close()
+
+    def _collect(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except queue.Empty:
+                break
+            n = status['shard']
+            previous = self.previous.get(n)
+            for port, health in status['ports'].items():
+                if previous is not None and port in previous['ports'] and 'frames' in health:
+                    elapsed = max(status['time'] - previous['time'], 1e-9)
+                    before  = previous['ports'][port]
+                    self.rates[port] = {'frames_per_s' : (health['frames'] - before.get('frames', 0)) / elapsed,
+                                        'bytes_per_s'  : (health['bytes'] - before.get('bytes', 0)) / elapsed}
+            self.previous[n] = status
+            self.status[n]   = status
+
+    def _check_workers(self):
+        for n, process in enumerate(self.processes):
+            if process is not None and not process.is_alive() and time.time() - self.started_at[n] >= RESTART_DELAY:
+                log.error('shard {0} exited with {1}, restarting'.format(n, process.exitcode))
+                self.restarts[n] += 1
+                self.previous.pop(n, None)
+                self._spawn(n)
+
+    def step(self, timeout=TICK):
+        """One supervisor iteration: hot-plug events, health reports and crashed workers"""
+        reopened = set()
+        for path in self.watcher.poll(timeout):
+            port = path if path in self.owner else self.device_keys.get(device_key(path))
+            if port is None or port in reopened:
+                continue
+            reopened.add(port)
+            log.info('{0} appeared as {1}, reopening'.format(port, path))
+            self.cmd_queues[self.owner[port]].put(('reopen', port, path))
+        self._collect()
+        self._check_workers()
+
+    def run(self):
+        if not self.running:
+            self.start()
+        while self.running:
+            self.step()
+
+    def health(self):
+        """Aggregated health and throughput of all shards"""
+        ports  = dict()
+        shards = dict()
+        for n in range(len(self.shards)):
+            status  = self.status.get(n, {'ports' : dict()})
+            process = self.processes[n]
+            shards[n] = {'pid'      : process.pid if process is not None else None,
+                         'alive'    : process is not None and process.is_alive(),
+                         'restarts' : self.restarts[n],
+                         'ports'    : self.shards[n]}
+            for port, health in status['ports'].items():
+                ports[port] = dict(health, **self.rates.get(port, {}))
+        return {'shards'       : shards,
+                'ports'        : ports,
+                'connected'    : len([p for p in ports.values() if p.get('connected')]),
+                'frames_per_s' : sum(p.get('frames_per_s', 0) for p in ports.values()),
+                'bytes_per_s'  : sum(p.get('bytes_per_s', 0) for p in ports.values())}
+
+############################################################################################
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    logging.basicConfig(level=logging.INFO)
+    arguments = docopt(__doc__)
+    ports = arguments['--dev']
+    if not ports:
+        from discovery import discover
+        ports = [device['port'] for device in discover()]
+
+    supervisor = Supervisor(ports,
+                            shards=int(arguments['--shards']),
+                            affinity=arguments['--affinity'],
+                            report_interval=float(arguments['--interval']),
+                            host=arguments['--redishost'])
+    supervisor.start()
+    try:
+        next_report = time.time()
+        while True:
+            supervisor.step()
+            if time.time() >= next_report:
+                next_report += supervisor.report_interval
+                health = supervisor.health()
+                log.info('connected {0}/{1} ports, {2:.1f} frames/s, {3:.0f} bytes/s'.format(
+                    health['connected'], len(ports), health['frames_per_s'], health['bytes_per_s']))
+    except KeyboardInterrupt:
+        supervisor.stop()
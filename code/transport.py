@@ -0,0 +1,199 @@
+"""transport.py -
+
+Pluggable transports for SerialRedisCom.
+
+SerialRedisCom only uses a small part of the redis client API: ping, the
+exchange set (sadd, srem, sismember, smembers), the key/value store (set, get,
+delete), publish and pubsub(). LocalBroker implements exactly that part in
+process so that single host deployments can run without a redis server.
+Messages are delivered through per subscriber queues with the same dict layout
+redis-py uses: {'type', 'pattern', 'channel', 'data'}.
+
+"""
+
+# Python
+import time
+import threading
+from fnmatch import fnmatchcase
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+##########################################################################################
+# Global definitions
+_default_broker = None
+_default_lock   = threading.Lock()
+
+def get_local_broker():
+    """Returns the process wide LocalBroker so that every component shares the same bus"""
+    global _default_broker
+    with _default_lock:
+        if _default_broker is None:
+            _default_broker = LocalBroker()
+        return _default_broker
+
+def get_transport(local=False, host='127.0.0.1'):
+    """Returns the shared LocalBroker when local is set, otherwise a redis client for host"""
+    if local:
+        return get_local_broker()
+    import redis
+    return redis.Redis(host=host)
+
+
+class LocalPubSub(object):
+    """
+    In process replacement for redis.client.PubSub.
+    """
+
+    def __init__(self, broker):
+        self.broker   = broker
+        self.queue    = queue.Queue()
+        self.channels = set()
+        self.patterns = set()
+
+    @property
+    def subscribed(self):
+        return bool(self.channels or self.patterns)
+
+    def _confirm(self, kind, name, pattern=None):
+        count = len(self.channels) + len(self.patterns)
+        self.queue.put({'type' : kind, 'pattern' : pattern, 'channel' : name, 'data' : count})
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self.broker._add_subscriber(self, channel)
+            self._confirm('subscribe', channel)
+
+    def psubscribe(self, *patterns):
+        for pattern in patterns:
+            self.patterns.add(pattern)
+            self.broker._add_subscriber(self, pattern, pattern=True)
+            self._confirm('psubscribe', pattern)
+
+    def unsubscribe(self, *channels):
+        for channel in (channels or list(self.channels)):
+            self.channels.discard(channel)
+            self.broker._remove_subscriber(self, channel)
+            self._confirm('unsubscribe', channel)
+
+    def punsubscribe(self, *patterns):
+        for pattern in (patterns or list(self.patterns)):
+            self.patterns.discard(pattern)
+            self.broker._remove_subscriber(self, pattern, pattern=True)
+            self._confirm('punsubscribe', pattern)
+
+    def close(self):
+        self.unsubscribe()
+        self.punsubscribe()
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        """Returns the next message or None when nothing arrived within timeout seconds"""
+        stop_at = time.time() + timeout
+        while True:
+            try:
+                remaining = stop_at - time.time()
+                if remaining > 0:
+                    item = self.queue.get(timeout=remaining)
+                else:
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                return None
+            if ignore_subscribe_messages and item['type'] not in ('message', 'pmessage'):
+                continue
+            return item
+
+    def listen(self):
+        """Blocking generator of messages, ends once unsubscribed from everything"""
+        while self.subscribed or not self.queue.empty():
+            yield self.queue.get()
+
+
+class LocalBroker(object):
+    """
+    Thread safe in process broker with the subset of the redis.Redis API used by SerialRedisCom.
+    """
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.store    = dict()
+        self.sets     = dict()
+        self.channels = dict()
+        self.patterns = dict()
+
+    # Connection
+    def ping(self):
+        return True
+
+    def pubsub(self):
+        return LocalPubSub(self)
+
+    # Key/value store
+    def set(self, key, value):
+        with self.lock:
+            self.store[key] = value
+        return True
+
+    def get(self, key):
+        with self.lock:
+            return self.store.get(key)
+
+    def delete(self, *keys):
+        with self.lock:
+            return len([self.store.pop(key) for key in keys if key in self.store])
+
+    # Sets, used for the exchange registry
+    def sadd(self, name, *values):
+        with self.lock:
+            members = self.sets.setdefault(name, set())
+            count   = len(members)
+            members.update(values)
+            return len(members) - count
+
+    def srem(self, name, *values):
+        with self.lock:
+            members = self.sets.get(name, set())
+            count   = len(members)
+            members.difference_update(values)
+            return count - len(members)
+
+    def sismember(self, name, value):
+        with self.lock:
+            return value in self.sets.get(name, ())
+
+    def smembers(self, name):
+        with self.lock:
+            return set(self.sets.get(name, ()))
+
+    # Pub/sub
+    def _add_subscriber(self, pubsub, name, pattern=False):
+        registry = self.patterns if pattern else self.channels
+        with self.lock:
+            registry.setdefault(name, set()).add(pubsub)
+
+    def _remove_subscriber(self, pubsub, name, pattern=False):
+        registry = self.patterns if pattern else self.channels
+        with self.lock:
+            subscribers = registry.get(name)
+            if subscribers is not None:
+                subscribers.discard(pubsub)
+                if not subscribers:
+                    del registry[name]
+
+    def publish(self, channel, message):
+        """Delivers message to every matching subscriber, returns the number of receivers"""
+        with self.lock:
+            direct   = list(self.channels.get(channel, ()))
+            patterns = [(pattern, list(subscribers)) for pattern, subscribers in self.patterns.items()
+                        if fnmatchcase(channel, pattern)]
+
+        for pubsub in direct:
+            pubsub.queue.put({'type' : 'message', 'pattern' : None, 'channel' : channel, 'data' : message})
+        count = len(direct)
+        for pattern, subscribers in patterns:
+            for pubsub in subscribers:
+                pubsub.queue.put({'type' : 'pmessage', 'pattern' : pattern, 'channel' : channel, 'data' : message})
+            count += len(subscribers)
+        return count
@@ -0,0 +1,406 @@
+"""tsstore.py -
+
+Columnar on-disk time-series store for decoded sensor values.
+
+Every (device, sensor) pair gets its own directory holding fixed size chunks.
+Each chunk is a pair of memory-mapped NumPy column files: one with the
+timestamps (float64, seconds since epoch) and one with the values (float64).
+A small index.json keeps the number of rows and the first/last timestamp of
+every chunk so range reads only touch the chunks they need and use
+searchsorted() inside of them. The index is only rewritten on flush() and when
+a chunk fills up, rows appended since the last flush are lost on a crash.
+
+Layout:
+  <root>/<device>/<sensor>/index.json
+  <root>/<device>/<sensor>/00000.t.npy
+  <root>/<device>/<sensor>/00000.v.npy
+  ...
+
+Usage:
+  tsstore.py sink [--root=ROOT] [--pattern=PATTERN] [--redishost=REDISHOST]
+  tsstore.py (-h | --help)
+
+Options:
+  -h, --help
+  --root=ROOT            [default: ./tsdata]
+  --pattern=PATTERN      [default: data.*]
+  --redishost=REDISHOST  [default: 127.0.0.1]
+
+"""
+
+# Python
+import os
+import re
+import json
+import time
+import threading
+from datetime import datetime
+from collections import deque
+
+# pip install
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+##########################################################################################
+# Global definitions
+CHUNK_SIZE  = 1 << 20
+INDEX_FILE  = 'index.json'
+TIME_FORMAT = '%Y-%m-%d-%H:%M:%S'
+SEEN_FRAMES = 4096
+
+re_unsafe = re.compile(r'[^A-Za-z0-9_.-]')
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+def safe_name(name):
+    """Turns device signature or sensor id into something usable as a directory name"""
+    return re_unsafe.sub('_', str(name)).strip('.') or '_'
+
+def to_epoch(timestamp):
+    """Accepts epoch seconds, datetime or the 'timestamp' string produced by SerialRedisCom"""
+    if timestamp is None:
+        return time.time()
+    if isinstance(timestamp, datetime):
+        return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    return time.mktime(datetime.strptime(timestamp, TIME_FORMAT).timetuple())
+
+
+class Column(object):
+    """
+    Append only time indexed column for a single (device, sensor) pair.
+    Timestamps are expected to be non decreasing, out of order samples are clamped
+    to the last timestamp so that the index stays sorted.
+    """
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path       = path
+        self.chunk_size = chunk_size
+        self.lock       = threading.Lock()
+        self._maps      = dict()
+        self._dirty     = False
+
+        index_file = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                index = json.load(f)
+            self.chunk_size = index['chunk_size']
+            self.chunks     = index['chunks']
+        else:
+            self.chunks = []
+
+    def _chunk_files(self, n):
+        base = os.path.join(self.path, '{0:05d}'.format(n))
+        return base + '.t.npy', base + '.v.npy'
+
+    def _open_chunk(self, n, mode='r'):
+        """Returns (t, v) memory maps for chunk n, write maps are cached"""
+        if n in self._maps:
+            return self._maps[n]
+        t_file, v_file = self._chunk_files(n)
+        if not os.path.exists(t_file):
+            shape = (self.chunk_size,)
+            t = np.lib.format.open_memmap(t_file, mode='w+', dtype=np.float64, shape=shape)
+            v = np.lib.format.open_memmap(v_file, mode='w+', dtype=np.float64, shape=shape)
+        else:
+            t = np.load(t_file, mmap_mode=mode)
+            v = np.load(v_file, mmap_mode=mode)
+        if mode != 'r':
+            self._maps[n] = (t, v)
+        return t, v
+
+    def _save_index(self):
+        index_file = os.path.join(self.path, INDEX_FILE)
+        tmp_file   = index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'chunk_size' : self.chunk_size, 'chunks' : self.chunks}, f)
+        os.rename(tmp_file, index_file)
+
+    def __len__(self):
+        return sum(c['rows'] for c in self.chunks)
+
+    def append(self, timestamps, values):
+        """Append arrays (or scalars) of timestamps and values"""
+        timestamps = np.atleast_1d(np.asarray(timestamps, dtype=np.float64))
+        values     = np.atleast_1d(np.asarray(values, dtype=np.float64))
+        if timestamps.shape != values.shape:
+            raise ValueError('timestamps and values must have the same length')
+
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            if len(self.chunks):
+                timestamps = np.maximum.accumulate(np.maximum(timestamps, self.chunks[-1]['last']))
+            else:
+                timestamps = np.maximum.accumulate(timestamps)
+
+            pos = 0
+            while pos < len(values):
+                if not len(self.chunks) or self.chunks[-1]['rows'] == self.chunk_size:
+                    self.chunks.append({'rows' : 0, 'first' : None, 'last' : None})
+                n     = len(self.chunks) - 1
+                chunk = self.chunks[n]
+                t, v  = self._open_chunk(n, mode='r+')
+                count = min(self.chunk_size - chunk['rows'], len(values) - pos)
+                t[chunk['rows']:chunk['rows'] + count] = timestamps[pos:pos + count]
+                v[chunk['rows']:chunk['rows'] + count] = values[pos:pos + count]
+                if chunk['first'] is None:
+                    chunk['first'] = float(timestamps[pos])
+                chunk['last']  = float(timestamps[pos + count - 1])
+                chunk['rows'] += count
+                pos += count
+                self._dirty = True
+                if chunk['rows'] == self.chunk_size:
+                    t.flush()
+                    v.flush()
+                    del self._maps[n]
+                    self._save_index()
+                    self._dirty = False
+
+    def flush(self):
+        """Writes the memory maps and the index to disk"""
+        with self.lock:
+            for t, v in self._maps.values():
+                t.flush()
+                v.flush()
+            if self._dirty:
+                self._save_index()
+                self._dirty = False
+
+    def read(self, start=None, stop=None):
+        """Returns (timestamps, values) arrays for start <= t < stop"""
+        start = -np.inf if start is None else to_epoch(start)
+        stop  =  np.inf if stop  is None else to_epoch(stop)
+
+        with self.lock:
+            chunks = [(n, dict(c)) for n, c in enumerate(self.chunks)]
+
+        t_parts, v_parts = [], []
+        for n, chunk in chunks:
+            if not chunk['rows'] or chunk['last'] < start or chunk['first'] >= stop:
+                continue
+            t, v = self._open_chunk(n)
+            t = t[:chunk['rows']]
+            i = np.searchsorted(t, start, side='left')
+            j = np.searchsorted(t, stop,  side='left')
+            t_parts.append(np.array(t[i:j]))
+            v_parts.append(np.array(v[i:j]))
+
+        if not t_parts:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(t_parts), np.concatenate(v_parts)
+
+    def downsample(self, start=None, stop=None, bucket=60.0, how='mean'):
+        """
+        Returns (bucket_start, value) arrays aggregated into buckets of `bucket` seconds.
+        how is one of mean, min, max, last. Empty buckets are omitted.
+        """
+        t, v = self.read(start, stop)
+        if not len(t):
+            return t, v
+        keys = np.floor(t / bucket)
+        edges = np.flatnonzero(np.diff(keys)) + 1
+        starts = np.concatenate(([0], edges))
+        if how == 'mean':
+            out = np.add.reduceat(v, starts) / np.diff(np.concatenate((starts, [len(v)])))
+        elif how == 'min':
+            out = np.minimum.reduceat(v, starts)
+        elif how == 'max':
+            out = np.maximum.reduceat(v, starts)
+        elif how == 'last':
+            out = v[np.concatenate((edges, [len(v)])) - 1]
+        else:
+            raise ValueError('unknown aggregation {}'.format(how))
+        return keys[starts] * bucket, out
+
+
+class TimeSeriesStore(object):
+    """
+    Collection of columns stored under a single root directory.
+    """
+
+    def __init__(self, root='./tsdata', chunk_size=CHUNK_SIZE):
+        if np is None:
+            raise ImportError('TimeSeriesStore requires numpy (pip install numpy)')
+        self.root       = root
+        self.chunk_size = chunk_size
+        self.columns    = dict()
+        self.lock       = threading.Lock()
+
+    def column(self, device, sensor):
+        key = (safe_name(device), safe_name(sensor))
+        with self.lock:
+            if key not in self.columns:
+                self.columns[key] = Column(os.path.join(self.root, *key), self.chunk_size)
+            return self.columns[key]
+
+    def append(self, device, sensor, timestamps, values):
+        self.column(device, sensor).append(timestamps, values)
+
+    def read(self, device, sensor, start=None, stop=None):
+        return self.column(device, sensor).read(start, stop)
+
+    def downsample(self, device, sensor, start=None, stop=None, bucket=60.0, how='mean'):
+        return self.column(device, sensor).downsample(start, stop, bucket, how)
+
+    def devices(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(os.listdir(self.root))
+
+    def sensors(self, device):
+        path = os.path.join(self.root, safe_name(device))
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.listdir(path))
+
+    def flush(self):
+        with self.lock:
+            columns = list(self.columns.values())
+        for column in columns:
+            column.flush()
+
+##########################################################################################
+# Decoding of the messages published by SerialRedisCom
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def extract_values(payload):
+    """
+    Yields (sensor, value) pairs for every numeric value found in the firmware payload.
+    Handles {"data": [[id, value], ...]}, {"data": {id: value}}, {"data": value}
+    and top level numeric fields.
+    """
+    if isinstance(payload, string_types):
+        try:
+            payload = json.loads(payload)
+        except ValueError:
+            return
+    if not isinstance(payload, dict):
+        return
+
+    prefix = payload.get('cmd', '')
+    data   = payload.get('data')
+    if is_number(data):
+        yield prefix or 'value', data
+    elif isinstance(data, dict):
+        for sensor, value in data.items():
+            if is_number(value):
+                yield sensor, value
+    elif isinstance(data, list):
+        for i, item in enumerate(data):
+            if isinstance(item, (list, tuple)) and len(item) >= 2 and is_number(item[-1]):
+                yield str(item[0]), item[-1]
+            elif is_number(item):
+                yield '{0}{1}'.format(prefix, i), item
+
+    for key, value in payload.items():
+        if key not in ('cmd', 'data') and is_number(value):
+            yield key, value
+
+def store_message(store, msg):
+    """Decodes a Message json published by SerialRedisCom and appends its values to store"""
+    data_dict = msg if isinstance(msg, dict) else json.loads(msg)
+    device    = data_dict['FROM']
+    body      = data_dict['MSG']
+    if not isinstance(body, dict) or 'data' not in body:
+        return 0
+    timestamp = to_epoch(body.get('timestamp'))
+    count = 0
+    for sensor, value in extract_values(body['data']):
+        store.append(device, sensor, timestamp, value)
+        count += 1
+    return count
+
+
+class RedisSink(object):
+    """
+    Pattern subscribes to the SerialRedisCom publish channels and appends all decoded numeric
+    values to a TimeSeriesStore. Runs in a daemon thread. The router publishes a frame once per
+    matching channel, so frames are de-duplicated by (FROM, frame_id). The MCU reuses
+    cmd_numbers after a resync or reset, frames of gateways that do not send a frame_id fall
+    back to (FROM, cmd_number, timestamp), which can drop a new frame within the same second.
+    """
+
+    def __init__(self, store, redis_client, pattern='data.*', flush_interval=1.0):
+        self.store          = store
+        self.redis          = redis_client
+        self.pattern        = pattern
+        self.flush_interval = flush_interval
+        self.seen           = set()
+        self.seen_order     = deque()
+        self.duplicates     = 0
+        self.alive          = False
+        self.stored  = 0
+        self.errors  = 0
+
+    def start(self):
+        self.alive  = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+        self.store.flush()
+
+    def handle(self, msg):
+        """Stores the values of msg unless the same frame was already stored, returns the count"""
+        data_dict = json.loads(msg)
+        body      = data_dict['MSG']
+        if isinstance(body, dict):
+            if 'frame_id' in body:
+                key = (data_dict['FROM'], body['frame_id'])
+            else:
+                key = (data_dict['FROM'], body.get('cmd_number'), body.get('timestamp'))
+            if key in self.seen:
+                self.duplicates += 1
+                return 0
+            self.seen.add(key)
+            self.seen_order.append(key)
+            if len(self.seen_order) > SEEN_FRAMES:
+                self.seen.discard(self.seen_order.popleft())
+        return store_message(self.store, data_dict)
+
+    def run(self):
+        pubsub = self.redis.pubsub()
+        pubsub.psubscribe(self.pattern)
+        next_flush = time.time() + self.flush_interval
+        while self.alive:
+            item = pubsub.get_message(timeout=0.5)
+            if time.time() >= next_flush:
+                self.store.flush()
+                next_flush = time.time() + self.flush_interval
+            if not item or item['type'] not in ('message', 'pmessage'):
+                continue
+            try:
+                self.stored += self.handle(item['data'])
+            except Exception:
+                self.errors += 1
+        pubsub.punsubscribe()
+
+############################################################################################
+
+if __name__ == '__main__':
+    import redis
+    from docopt import docopt
+
+    arguments = docopt(__doc__)
+    if arguments['sink']:
+        sink = RedisSink(TimeSeriesStore(arguments['--root']),
+                         redis.Redis(host=arguments['--redishost']),
+                         arguments['--pattern'])
+        sink.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            sink.stop()
@@ -3,5 +3,10 @@
 import sys
 import os
 sys.path.insert(0, os.path.abspath('..'))
+# the modules in code/ import each other by their plain names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
 
-import sample
\ No newline at end of file
+try:
+    import sample
+except ImportError:
+    sample = None
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import discovery
+import emulator
+
+
+class BootingComPort(emulator.EmulatedComPort):
+    """Ignores input while the bootloader runs, like an Arduino reset by opening the port"""
+
+    def __init__(self, port, boot_time):
+        emulator.EmulatedComPort.__init__(self, port)
+        self.ready_at = time.time() + boot_time
+
+    def write(self, data):
+        if time.time() < self.ready_at:
+            return len(data)
+        return emulator.EmulatedComPort.write(self, data)
+
+
+class SilentPort(object):
+
+    def write(self, data):
+        return len(data)
+
+    def inWaiting(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class DiscoveryTestSuite(unittest.TestCase):
+    """Parallel probing and the serial number cache."""
+
+    def setUp(self):
+        self.root       = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.root, 'cache', 'discovery.json')
+        self.probed     = []
+        self.usb_serial_number = discovery.usb_serial_number
+        discovery.usb_serial_number = lambda port: 'SN-' + os.path.basename(port)
+
+    def tearDown(self):
+        discovery.usb_serial_number = self.usb_serial_number
+        shutil.rmtree(self.root)
+
+    def opener(self, port, baudrate, timeout):
+        self.probed.append(port)
+        if port.endswith('0'):
+            return BootingComPort(port, boot_time=0.3)
+        return SilentPort()
+
+    def test_probe_retries_until_board_booted(self):
+        device = discovery.probe('/dev/ttyUSB0', timeout=2, opener=self.opener, retry=0.05)
+        self.assertEqual(device['firmware'], 'ComPort')
+        self.assertEqual(device['response'], 'ComPort')
+
+    def test_probe_gives_up_after_timeout(self):
+        t0 = time.time()
+        self.assertEqual(discovery.probe('/dev/ttyUSB1', timeout=0.2, opener=self.opener), None)
+        self.assertTrue(time.time() - t0 < 1)
+
+    def test_parallel_discovery_and_cache(self):
+        ports = ['/dev/ttyUSB{}'.format(i) for i in range(4)]
+        t0 = time.time()
+        devices = discovery.discover(ports, timeout=0.6, cache_file=self.cache_file, opener=self.opener, retry=0.05)
+        self.assertTrue(time.time() - t0 < 1.5)
+        self.assertEqual([d['port'] for d in devices], ['/dev/ttyUSB0'])
+        self.assertFalse(devices[0]['cached'])
+        self.assertEqual(sorted(self.probed), ports)
+
+        # a port whose serial number is cached is not probed again
+        self.probed = []
+        devices = discovery.discover(['/dev/ttyUSB0'], timeout=0.6, cache_file=self.cache_file, opener=self.opener)
+        self.assertTrue(devices[0]['cached'])
+        self.assertEqual(self.probed, [])
+
+
+class MultiPortAdapterTestSuite(unittest.TestCase):
+    """The ttys of one two-port adapter share a serial number but not their cache entry."""
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.sys  = (discovery.SYS_TTY, discovery.SYS_DEVICES)
+        discovery.SYS_TTY     = os.path.join(self.root, 'class', 'tty')
+        discovery.SYS_DEVICES = os.path.join(self.root, 'devices')
+
+        usb_device = os.path.join(discovery.SYS_DEVICES, 'pci0000:00', 'usb1', '1-1')
+        self.write(os.path.join(usb_device, 'serial'), 'FT2232A\n')
+        for interface in range(2):
+            interface_dir = os.path.join(usb_device, '1-1:1.{}'.format(interface))
+            self.write(os.path.join(interface_dir, 'bInterfaceNumber'), '0{}\n'.format(interface))
+            tty_dir = os.path.join(interface_dir, 'ttyUSB{}'.format(interface))
+            os.makedirs(tty_dir)
+            class_dir = os.path.join(discovery.SYS_TTY, 'ttyUSB{}'.format(interface))
+            os.makedirs(class_dir)
+            os.symlink(tty_dir, os.path.join(class_dir, 'device'))
+
+        self.cache_file = os.path.join(self.root, 'discovery.json')
+        self.probed     = []
+
+    def tearDown(self):
+        discovery.SYS_TTY, discovery.SYS_DEVICES = self.sys
+        shutil.rmtree(self.root)
+
+    def write(self, path, data):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def opener(self, port, baudrate, timeout):
+        self.probed.append(port)
+        if port.endswith('0'):
+            return emulator.EmulatedComPort(port)
+        return SilentPort()
+
+    def test_device_key(self):
+        self.assertEqual(discovery.usb_serial_number('/dev/ttyUSB0'), 'FT2232A')
+        self.assertEqual(discovery.usb_serial_number('/dev/ttyUSB1'), 'FT2232A')
+        self.assertEqual(discovery.device_key('/dev/ttyUSB0'), 'FT2232A-if00')
+        self.assertEqual(discovery.device_key('/dev/ttyUSB1'), 'FT2232A-if01')
+        self.assertEqual(discovery.device_key('/dev/ttyNONE'), None)
+
+    def test_sibling_port_is_probed(self):
+        ports   = ['/dev/ttyUSB0', '/dev/ttyUSB1']
+        devices = discovery.discover(ports, timeout=0.3, cache_file=self.cache_file, opener=self.opener)
+        self.assertEqual([d['port'] for d in devices], ['/dev/ttyUSB0'])
+
+        self.probed = []
+        devices = discovery.discover(ports, timeout=0.3, cache_file=self.cache_file, opener=self.opener)
+        self.assertEqual([(d['port'], d['cached']) for d in devices], [('/dev/ttyUSB0', True)])
+        self.assertEqual(self.probed, ['/dev/ttyUSB1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
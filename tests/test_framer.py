@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import unittest
+
+import emulator
+from framer import Framer
+
+
+def frame(n, cmd='T', data='[]'):
+    return '<{0}>{{"cmd":"{1}","data":{2}}}</{0}>\r\n'.format(n, cmd, data)
+
+
+class FramerTestSuite(unittest.TestCase):
+    """Resynchronizing framer."""
+
+    def setUp(self):
+        self.framer = Framer(max_frame=200, window=10, max_error_rate=0.2)
+
+    def numbers(self, frames):
+        return [cmd_number for cmd_number, payload, raw in frames]
+
+    def test_clean_frames(self):
+        frames = self.framer.feed(frame(1) + frame(2))
+        self.assertEqual(self.numbers(frames), ['1', '2'])
+        self.assertEqual(frames[0][1], '{"cmd":"T","data":[]}')
+        self.assertEqual(frames[0][2], '<1>{"cmd":"T","data":[]}</1>')
+        self.assertEqual(self.framer.errors, 0)
+        self.assertEqual(self.framer.buffer, '')
+
+    def test_frame_split_across_reads(self):
+        data = frame(7)
+        self.assertEqual(self.framer.feed(data[:5]), [])
+        self.assertEqual(self.numbers(self.framer.feed(data[5:])), ['7'])
+        self.assertEqual(self.framer.errors, 0)
+
+    def test_partial_start_tag_is_kept(self):
+        self.assertEqual(self.framer.feed('<1'), [])
+        self.assertEqual(self.framer.buffer, '<1')
+        self.assertEqual(self.numbers(self.framer.feed('2>{"cmd":"T"}</12>')), ['12'])
+        self.assertEqual(self.framer.errors, 0)
+
+    def test_garbage_before_frame_is_skipped(self):
+        frames = self.framer.feed('#@!xx' + frame(3))
+        self.assertEqual(self.numbers(frames), ['3'])
+        self.assertEqual(self.framer.skipped_bytes, 5)
+        self.assertEqual(self.framer.errors, 1)
+
+    def test_truncated_frame_followed_by_restart(self):
+        frames = self.framer.feed('<4>{"cmd":"T","da' + '\r\n' + frame(5))
+        self.assertEqual(self.numbers(frames), ['5'])
+        self.assertEqual(self.framer.errors, 1)
+        self.assertEqual(self.framer.skipped_bytes, len('<4>{"cmd":"T","da'))
+
+    def test_max_frame_overflow(self):
+        self.assertEqual(self.framer.feed('<9>' + 'x' * 300), [])
+        self.assertEqual(self.framer.errors, 1)
+        self.assertTrue(len(self.framer.buffer) <= 200)
+        self.assertEqual(self.numbers(self.framer.feed(frame(10))), ['10'])
+
+    def test_corrupted_payload_is_an_error(self):
+        frames = self.framer.feed('<5>{"cm#@!d":"T"}</5>\r\n' + '<6>{"cmd":"T",#}</6>\r\n' + frame(7))
+        self.assertEqual(self.numbers(frames), ['7'])
+        self.assertEqual(self.framer.errors, 2)
+        self.assertEqual(self.framer.frames, 1)
+
+    def test_error_window(self):
+        self.framer.feed(frame(1))
+        self.framer.feed('garbage\r\n')
+        self.framer.feed('garbage\r\n')
+        self.assertFalse(self.framer.needs_resync())
+        self.framer.feed('garbage\r\n')
+        self.assertTrue(self.framer.needs_resync())
+        self.framer.resynced()
+        self.assertFalse(self.framer.needs_resync())
+        self.assertEqual(self.framer.stats()['resyncs'], 1)
+
+    def test_line_endings_are_not_errors(self):
+        self.framer.feed('\r\n\r\n' + frame(1) + '\r\n')
+        self.assertEqual(self.framer.errors, 0)
+
+
+class FramerBenchmarkTestSuite(unittest.TestCase):
+    """The framer keeps more intact frames than the legacy decoder on a noisy line."""
+
+    def test_noisy_stream(self):
+        result = emulator.benchmark(frames=2000, noise=0.05)
+        self.assertTrue(result['framer_intact'] > 0.9 * result['sent'])
+        self.assertTrue(result['framer_intact'] > result['legacy_intact'])
+        self.assertTrue(result['framer_bad'] < 0.01 * result['sent'])
+
+    def test_clean_stream(self):
+        result = emulator.benchmark(frames=500, noise=0)
+        self.assertEqual(result['framer_intact'], 500)
+        self.assertEqual(result['framer_bad'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
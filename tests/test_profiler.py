@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import os
+import time
+import threading
+import unittest
+
+import profiler
+
+
+class SamplingProfilerTestSuite(unittest.TestCase):
+    """Sampling profiler used by the !profile control command."""
+
+    def setUp(self):
+        self.stop_busy = threading.Event()
+        self.busy = threading.Thread(target=self._busy, name='reader')
+        self.busy.daemon = True
+        self.busy.start()
+
+    def tearDown(self):
+        self.stop_busy.set()
+        self.busy.join()
+
+    def _busy(self):
+        while not self.stop_busy.is_set():
+            sum(range(100))
+
+    def test_running_is_set_before_thread_starts(self):
+        p = profiler.SamplingProfiler([self.busy])
+        p.start(10)
+        self.assertTrue(p.running)
+        p.stop()
+        self.assertFalse(p.running)
+
+    def test_collapsed_output(self):
+        done = threading.Event()
+        p = profiler.SamplingProfiler([self.busy], interval=0.001)
+        p.start(0.1, lambda pr: done.set())
+        self.assertTrue(done.wait(5))
+        self.assertTrue(p.count > 0)
+
+        path = p.write(prefix='test')
+        try:
+            with open(path) as f:
+                lines = f.read().split('\n')
+            self.assertTrue(lines[0].startswith('reader;'))
+            self.assertTrue(int(lines[0].rsplit(' ', 1)[1]) > 0)
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
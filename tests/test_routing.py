@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import unittest
+
+import routing
+import transport
+
+FINAL_DATA = {'cmd_number' : '3', 'timestamp' : '2026-01-01-00:00:00',
+              'data' : '{"cmd":"T","data":[["28FF01",21.5],["28FF02",22.0]]}'}
+
+
+class TopicRouterTestSuite(unittest.TestCase):
+    """Topic partitioned fan-out of frames."""
+
+    def test_default_channel(self):
+        router = routing.TopicRouter()
+        self.assertEqual(router.channels('10.0.0.1:/dev/ttyUSB0', FINAL_DATA), ['data.10_0_0_1:/dev/ttyUSB0.T'])
+
+    def test_sensor_fan_out_and_legacy(self):
+        router = routing.TopicRouter(templates=['data.{signature}.{sensor}', 'data.{missing}'], legacy=True)
+        self.assertEqual(router.channels('dev', FINAL_DATA), ['data.dev.28FF01', 'data.dev.28FF02', 'data'])
+
+    def test_unparsable_payload_uses_only_complete_templates(self):
+        router = routing.TopicRouter(templates=['data.{signature}.{cmd}', 'raw.{signature}'])
+        self.assertEqual(router.channels('dev', {'cmd_number' : '1', 'data' : 'garbage'}), ['raw.dev'])
+
+    def test_cmd_number_is_not_a_field(self):
+        self.assertRaises(ValueError, routing.TopicRouter, ['data.{cmd_number}'])
+
+    def test_publish_counts_and_pattern_subscribers(self):
+        broker = transport.LocalBroker()
+        pubsub = broker.pubsub()
+        pubsub.psubscribe('data.*.T')
+        router = routing.TopicRouter()
+        router.publish(broker, 'dev', FINAL_DATA, 'message')
+        router.publish(broker, 'dev', FINAL_DATA, 'message')
+        self.assertEqual(router.stats(), {'data.dev.T' : 2})
+        item = pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+        self.assertEqual(item['channel'], 'data.dev.T')
+
+    def test_counts_are_capped(self):
+        broker = transport.LocalBroker()
+        router = routing.TopicRouter(templates=['data.{signature}'], max_channels=3)
+        for i in range(10):
+            router.publish(broker, 'dev{}'.format(i), FINAL_DATA, 'message')
+        stats = router.stats()
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(stats[routing.OTHER], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
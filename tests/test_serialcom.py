@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import io
+import sys
+import time
+import unittest
+
+import emulator
+import transport
+
+PY2 = sys.version_info[0] == 2
+
+try:
+    import serial
+    import docopt
+    import redislog
+    HAVE_DEPENDENCIES = True
+except ImportError:
+    HAVE_DEPENDENCIES = False
+
+serialcom = None
+if PY2 and HAVE_DEPENDENCIES:
+    import serialcom
+
+
+class LossyComPort(emulator.EmulatedComPort):
+    """Drops the response to the next `drop` commands"""
+    drop = 0
+
+    def _transmit(self, data):
+        if self.drop:
+            self.drop -= 1
+            return
+        emulator.EmulatedComPort._transmit(self, data)
+
+
+class RemoteBroker(object):
+    """A LocalBroker that does not look local, like the redis client of a detached worker"""
+
+    def __init__(self):
+        self.broker = transport.LocalBroker()
+
+    def __getattr__(self, name):
+        return getattr(self.broker, name)
+
+
+class InterruptingComPort(emulator.EmulatedComPort):
+    """Sends an unsolicited frame with the same cmd letter before answering command number `at`"""
+    commands = 0
+    at       = 2
+
+    def _execute(self, cmd):
+        self.commands += 1
+        if self.commands == self.at:
+            self._transmit(self.frame('T', [['28FF_INTERRUPT', 1.0]]))
+        emulator.EmulatedComPort._execute(self, cmd)
+
+
+class SlowInterruptingComPort(InterruptingComPort):
+    """Interrupts before the first response on a 9600 baud line, so responses arrive one by one"""
+    at = 1
+
+    def __init__(self, port):
+        InterruptingComPort.__init__(self, port, baudrate=9600)
+
+
+@unittest.skipUnless(PY2, 'serialcom.py is Python 2 code')
+@unittest.skipUnless(HAVE_DEPENDENCIES, 'pyserial, docopt or python-redis-log can not be imported')
+class QueryManyTestSuite(unittest.TestCase):
+    """Pipelined query_many() against the firmware emulator."""
+
+    def open(self, port_class, broker=None):
+        self.serial_class = serialcom.serial.Serial
+        serialcom.serial.Serial = lambda port, *args: port_class(port)
+        try:
+            self.com = serialcom.SerialRedisCom(port='/dev/emulated', transport=broker or transport.LocalBroker())
+        finally:
+            serialcom.serial.Serial = self.serial_class
+        return self.com
+
+    def tearDown(self):
+        self.com.close()
+
+    def test_results_in_order(self):
+        com = self.open(emulator.EmulatedComPort)
+        results = com.query_many(['T1', 'T2', 'T3'], timeout=1)
+        self.assertEqual([done for done, final_data in results], [True, True, True])
+        numbers = [int(final_data['cmd_number']) for done, final_data in results]
+        self.assertEqual(numbers, [numbers[0], numbers[0] + 1, numbers[0] + 2])
+        self.assertEqual(len(set(final_data['frame_id'] for done, final_data in results)), 3)
+
+    def test_lost_response_does_not_block_later_batches(self):
+        com = self.open(LossyComPort)
+        com.serial.drop = 1
+        com.send('T0')
+        time.sleep(0.1)
+        self.assertEqual(com.in_flight, 1)
+
+        for i in range(3):
+            t0 = time.time()
+            results = com.query_many(['T1', 'T2'], timeout=1)
+            self.assertEqual([done for done, final_data in results], [True, True])
+            self.assertTrue(time.time() - t0 < com.drain_timeout + 0.5)
+        self.assertEqual(com.in_flight, 0)
+
+    def test_unsolicited_frame_is_never_reported_as_success(self):
+        com = self.open(InterruptingComPort)
+        results = com.query_many(['T1', 'T2', 'T3'], timeout=1)
+        self.assertEqual([done for done, final_data in results], [False, False, False])
+    def test_settle_catches_frame_before_first_response(self):
+        com = self.open(SlowInterruptingComPort)
+        results = com.query_many(['T1', 'T2', 'T3'], timeout=1, settle=0.2)
+        self.assertEqual([done for done, final_data in results], [False, False, False])
+
+    def test_detached_process_has_a_logger(self):
+        stdout, sys.stdout = sys.stdout, io.StringIO()
+        try:
+            com = self.open(emulator.EmulatedComPort, RemoteBroker())
+        finally:
+            sys.stdout = stdout
+        self.assertFalse(com.local)
+        com.log.info('detached')
+        self.assertEqual([done for done, final_data in com.query_many(['T1'], timeout=1)], [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
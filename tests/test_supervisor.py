@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import discovery
+import supervisor
+
+
+class ShardPortsTestSuite(unittest.TestCase):
+    """Round robin assignment of ports to worker processes."""
+
+    def test_round_robin(self):
+        self.assertEqual(supervisor.shard_ports(['a', 'b', 'c'], 2), [['a', 'c'], ['b']])
+        self.assertEqual(supervisor.shard_ports(['a'], 4), [['a']])
+
+
+@unittest.skipIf(not hasattr(os, 'sched_getaffinity'), 'needs os.sched_getaffinity to check the result')
+class AffinityTestSuite(unittest.TestCase):
+    """Pinning workers to a CPU, also where only libc provides sched_setaffinity."""
+
+    def setUp(self):
+        self.allowed = os.sched_getaffinity(0)
+        self.cpu     = max(self.allowed)
+
+    def tearDown(self):
+        os.sched_setaffinity(0, self.allowed)
+
+    def test_set_affinity(self):
+        self.assertTrue(supervisor.set_affinity(self.cpu))
+        self.assertEqual(os.sched_getaffinity(0), set([self.cpu]))
+
+    def test_libc_set_affinity(self):
+        self.assertTrue(supervisor.libc_set_affinity(self.cpu))
+        self.assertEqual(os.sched_getaffinity(0), set([self.cpu]))
+
+
+class DevWatcherTestSuite(unittest.TestCase):
+    """Hot-plug detection by stable path and by newly created ttys."""
+
+    def setUp(self):
+        self.root  = tempfile.mkdtemp()
+        self.by_id = os.path.join(self.root, 'by-id')
+        os.mkdir(self.by_id)
+        self.tty0  = self.touch('ttyUSB0')
+        self.link  = os.path.join(self.by_id, 'usb-FTDI_A1B2-if00-port0')
+        os.symlink(self.tty0, self.link)
+        self.by_id_dir, discovery.BY_ID_DIR = discovery.BY_ID_DIR, self.by_id
+
+    def tearDown(self):
+        discovery.BY_ID_DIR = self.by_id_dir
+        shutil.rmtree(self.root)
+
+    def touch(self, name):
+        path = os.path.join(self.root, name)
+        open(path, 'w').close()
+        return path
+
+    def watcher(self):
+        watcher = supervisor.DevWatcher([self.link], directory=self.root,
+                                        patterns=(os.path.join(self.root, 'ttyUSB*'),))
+        self.addCleanup(watcher.close)
+        return watcher
+
+    def test_stable_port(self):
+        self.assertEqual(discovery.stable_port(self.tty0), self.link)
+        self.assertEqual(discovery.stable_port(self.link), self.link)
+        self.assertEqual(discovery.stable_port('/dev/ttyNONE'), '/dev/ttyNONE')
+
+    def test_replugged_device(self):
+        watcher = self.watcher()
+        self.assertEqual(watcher.poll(0.01), [])
+
+        os.remove(self.tty0)
+        self.assertEqual(watcher.poll(0.01), [])
+
+        tty1 = self.touch('ttyUSB1')
+        os.remove(self.link)
+        os.symlink(tty1, self.link)
+        self.assertEqual(sorted(watcher.poll(0.01)), sorted([self.link, tty1]))
+        self.assertEqual(watcher.poll(0.01), [])
+
+
+class SupervisorStepTestSuite(unittest.TestCase):
+    """A device that came back under another tty name is reopened by its owning shard."""
+
+    class Watcher(object):
+        def __init__(self, appeared):
+            self.appeared = appeared
+
+        def poll(self, timeout):
+            appeared, self.appeared = self.appeared, []
+            return appeared
+
+    def setUp(self):
+        keys = {'/dev/ttyUSB0' : 'A1B2-if00', '/dev/ttyUSB1' : 'C3D4-if00', '/dev/ttyUSB2' : 'C3D4-if01',
+                '/dev/ttyUSB7' : 'C3D4-if01', '/dev/ttyUSB8' : 'E5F6', '/dev/ttyUSB9' : 'E5F6'}
+        self.device_key = supervisor.device_key
+        supervisor.device_key = keys.get
+
+    def tearDown(self):
+        supervisor.device_key = self.device_key
+
+    def test_reopen_by_device_key(self):
+        sv = supervisor.Supervisor(['/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2'], shards=3)
+        sv.watcher = self.Watcher(['/dev/ttyUSB7', '/dev/ttyUSB5'])
+        sv.step(0)
+        self.assertEqual(sv.cmd_queues[2].get(timeout=1), ('reopen', '/dev/ttyUSB2', '/dev/ttyUSB7'))
+        self.assertTrue(sv.cmd_queues[0].empty())
+        self.assertTrue(sv.cmd_queues[1].empty())
+
+    def test_duplicate_device_key_is_not_followed(self):
+        sv = supervisor.Supervisor(['/dev/ttyUSB0', '/dev/ttyUSB8', '/dev/ttyUSB9'], shards=3)
+        self.assertEqual(sv.device_keys, {'A1B2-if00' : '/dev/ttyUSB0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import threading
+import unittest
+
+import transport
+
+
+class LocalBrokerTestSuite(unittest.TestCase):
+    """In-process replacement for the redis client."""
+
+    def setUp(self):
+        self.broker = transport.LocalBroker()
+
+    def test_key_value(self):
+        self.assertTrue(self.broker.set('k', 'v'))
+        self.assertEqual(self.broker.get('k'), 'v')
+        self.assertEqual(self.broker.delete('k', 'missing'), 1)
+        self.assertEqual(self.broker.get('k'), None)
+
+    def test_exchange_set(self):
+        self.assertEqual(self.broker.sadd('ComPort', 'a', 'b'), 2)
+        self.assertEqual(self.broker.sadd('ComPort', 'a'), 0)
+        self.assertTrue(self.broker.sismember('ComPort', 'a'))
+        self.assertEqual(self.broker.srem('ComPort', 'a'), 1)
+        self.assertEqual(self.broker.smembers('ComPort'), set(['b']))
+
+    def test_subscribe_and_publish(self):
+        pubsub = self.broker.pubsub()
+        pubsub.subscribe('chan')
+        self.assertEqual(pubsub.get_message()['type'], 'subscribe')
+        self.assertEqual(self.broker.publish('chan', 'hello'), 1)
+        self.assertEqual(self.broker.publish('other', 'hello'), 0)
+        item = pubsub.get_message(timeout=1)
+        self.assertEqual((item['type'], item['channel'], item['data']), ('message', 'chan', 'hello'))
+        self.assertEqual(pubsub.get_message(), None)
+
+    def test_pattern_subscribe(self):
+        pubsub = self.broker.pubsub()
+        pubsub.psubscribe('data.*.T')
+        self.assertEqual(self.broker.publish('data.dev.T', 'x'), 1)
+        self.assertEqual(self.broker.publish('data.dev.A', 'x'), 0)
+        item = pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+        self.assertEqual((item['type'], item['pattern'], item['channel']), ('pmessage', 'data.*.T', 'data.dev.T'))
+
+    def test_listen_ends_after_unsubscribe(self):
+        pubsub = self.broker.pubsub()
+        pubsub.subscribe('chan')
+        received = []
+
+        def listen():
+            for item in pubsub.listen():
+                received.append(item['type'])
+                if item['type'] == 'message':
+                    pubsub.unsubscribe()
+
+        thread = threading.Thread(target=listen)
+        thread.start()
+        self.broker.publish('chan', 'stop')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(received, ['subscribe', 'message', 'unsubscribe'])
+
+    def test_shared_local_broker(self):
+        self.assertTrue(transport.get_transport(local=True) is transport.get_local_broker())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+from .context import sample
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import routing
+import tsstore
+import transport
+
+
+@unittest.skipIf(tsstore.np is None, 'numpy is not installed')
+class TimeSeriesStoreTestSuite(unittest.TestCase):
+    """Columnar time-series store."""
+
+    def setUp(self):
+        self.root  = tempfile.mkdtemp()
+        self.store = tsstore.TimeSeriesStore(self.root, chunk_size=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_range_read_spans_chunks(self):
+        np = tsstore.np
+        t  = np.arange(1000, dtype=float)
+        self.store.append('dev', 's1', t, t * 2)
+        tt, vv = self.store.read('dev', 's1', 250, 750)
+        self.assertEqual(len(tt), 500)
+        self.assertEqual(tt[0], 250)
+        self.assertEqual(tt[-1], 749)
+        self.assertTrue((vv == tt * 2).all())
+
+    def test_downsample(self):
+        np = tsstore.np
+        t  = np.arange(100, dtype=float)
+        self.store.append('dev', 's1', t, t)
+        b, v = self.store.downsample('dev', 's1', bucket=10)
+        self.assertEqual(list(b), list(range(0, 100, 10)))
+        self.assertEqual(v[0], 4.5)
+        b, v = self.store.downsample('dev', 's1', bucket=10, how='max')
+        self.assertEqual(v[-1], 99)
+
+    def test_index_written_on_flush_and_reopen(self):
+        self.store.append('dev', 's1', [1.0, 2.0, 3.0], [10.0, 20.0, 30.0])
+        index_file = os.path.join(self.root, 'dev', 's1', tsstore.INDEX_FILE)
+        self.assertFalse(os.path.exists(index_file))
+        self.store.flush()
+        with open(index_file) as f:
+            self.assertEqual(json.load(f)['chunks'][0]['rows'], 3)
+
+        reopened = tsstore.TimeSeriesStore(self.root)
+        tt, vv = reopened.read('dev', 's1')
+        self.assertEqual(list(vv), [10.0, 20.0, 30.0])
+
+    def test_chunk_rollover_writes_index(self):
+        self.store.append('dev', 's1', range(150), range(150))
+        index_file = os.path.join(self.root, 'dev', 's1', tsstore.INDEX_FILE)
+        self.assertTrue(os.path.exists(index_file))
+
+    def test_out_of_order_timestamps_are_clamped(self):
+        self.store.append('dev', 's1', [5.0, 3.0, 6.0], [1.0, 2.0, 3.0])
+        tt, vv = self.store.read('dev', 's1')
+        self.assertEqual(list(tt), [5.0, 5.0, 6.0])
+
+    def test_read_unknown_sensor_creates_nothing(self):
+        tt, vv = self.store.read('nodev', 'nosensor')
+        self.assertEqual(len(tt), 0)
+        self.store.downsample('nodev', 'nosensor')
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_store_message(self):
+        msg = {'FROM' : '10.0.0.1:/dev/ttyUSB0', 'TO' : '',
+               'MSG'  : {'timestamp' : '2026-01-01-00:00:00', 'cmd_number' : '3',
+                         'data' : '{"cmd":"T","data":[["28FF01",21.5],["28FF02",22.0]]}'}}
+        self.assertEqual(tsstore.store_message(self.store, json.dumps(msg)), 2)
+        tt, vv = self.store.read('10.0.0.1:/dev/ttyUSB0', '28FF02')
+        self.assertEqual(list(vv), [22.0])
+
+    def test_sink_stores_fanned_out_frame_once(self):
+        broker = transport.LocalBroker()
+        router = routing.TopicRouter(templates=['data.{signature}.{cmd}', 'data.{signature}.{sensor}'])
+        sink   = tsstore.RedisSink(self.store, broker)
+        final_data = {'timestamp' : '2026-01-01-00:00:00', 'cmd_number' : '3', 'raw' : '', 'frame_id' : 'a1b2-0',
+                      'data' : '{"cmd":"T","data":[["28FF01",21.5],["28FF02",22.0]]}'}
+        msg = json.dumps({'FROM' : 'dev', 'TO' : '', 'MSG' : final_data})
+
+        sink.start()
+        try:
+            time.sleep(0.1)
+            self.assertEqual(len(router.publish(broker, 'dev', final_data, msg)), 3)
+            deadline = time.time() + 5
+            while sink.duplicates < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            sink.stop()
+        self.assertEqual(sink.stored, 2)
+        self.assertEqual(sink.duplicates, 2)
+        tt, vv = self.store.read('dev', '28FF01')
+        self.assertEqual(list(vv), [21.5])
+
+    def test_sink_keeps_reused_cmd_number(self):
+        # after a resync the MCU counter restarts, the same cmd_number can come back within a second
+        sink = tsstore.RedisSink(self.store, transport.LocalBroker())
+        for frame_id, value in (('a1b2-0', 21.5), ('a1b2-1', 21.6), ('a1b2-1', 21.6)):
+            final_data = {'timestamp' : '2026-01-01-00:00:00', 'cmd_number' : '1', 'frame_id' : frame_id,
+                          'data' : '{"cmd":"T","data":[["28FF01",%s]]}' % value}
+            sink.handle(json.dumps({'FROM' : 'dev', 'TO' : '', 'MSG' : final_data}))
+        self.assertEqual(sink.duplicates, 1)
+        tt, vv = self.store.read('dev', '28FF01')
+        self.assertEqual(list(vv), [21.5, 21.6])
+
+
+class ExtractValuesTestSuite(unittest.TestCase):
+    """Decoding of numeric values from firmware payloads."""
+
+    def test_payload_shapes(self):
+        self.assertEqual(list(tsstore.extract_values('{"cmd":"A","data":3}')), [('A', 3)])
+        self.assertEqual(list(tsstore.extract_values({'cmd' : 'T', 'data' : {'x' : 1.5}})), [('x', 1.5)])
+        self.assertEqual(list(tsstore.extract_values('{"cmd":"A","data":[1,2]}')), [('A0', 1), ('A1', 2)])
+        self.assertEqual(list(tsstore.extract_values('not json')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()